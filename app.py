@@ -1,37 +1,117 @@
 import streamlit as st
-import google.generativeai as genai
-import os
-import json
-import re
-from dotenv import load_dotenv
+import time
+import uuid
+from contextlib import ExitStack
+from quiz import parse_response, StreamingQuizExtractor
+from quiz_grading import build_grading_prompt, grade_locally
+from response_cache import ResponseCache, make_cache_key
+from session_store import SessionStore
+from context_builder import build_file_context, estimate_tokens
+from prompt_templates import GOALS, LANGUAGES, LEVELS, get_template, render_prompt
+from prefix_cache import cached_token_ratio
+from chat_session import SUMMARY_MAX_OUTPUT_TOKENS as CHAT_SUMMARY_MAX_OUTPUT_TOKENS, FollowUpChat
+from upload_batch import (
+    build_batch_context, expand_uploads, files_to_summarize, load_files, summarize_files,
+)
+from gemini_client import (
+    DEFAULT_MODEL_NAME, get_api_key, get_model, get_prefix_cache, get_scheduler, warm_up, warm_up_enabled,
+)
+from request_scheduler import PRIORITY_BACKGROUND, PRIORITY_EXPLANATION, PRIORITY_GRADING
+from metrics import NULL_METRICS, MetricsSink, export_enabled, start_request
 # from supabase import create_client, Client # Supabase未使用のためコメントアウト継続
 
 # --- 初期設定 ---
-load_dotenv()
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
+# .envの読み込みとモデルの作成は gemini_client 側でプロセスにつき1回だけ行う
+if not get_api_key():
     st.error("エラー: GOOGLE_API_KEYが設定されていません。.envファイルを確認してください。")
     st.stop()
-genai.configure(api_key=GOOGLE_API_KEY)
 
-try:
-    # モデル名を一般的な最新Flashモデルに戻す
-    model = genai.GenerativeModel('gemini-2.0-flash')
-except Exception as e:
-    st.error(f"Geminiモデルの読み込みに失敗しました: {e}")
-    st.stop()
+# モデル名を一般的な最新Flashモデルに戻す
+MODEL_NAME = DEFAULT_MODEL_NAME
+if warm_up_enabled():
+    warm_up(MODEL_NAME)
+
+def load_model():
+    # google.generativeai の読み込みとモデルの作成は、最初にリクエストを送るときに1回だけ行われる
+    try:
+        return get_model(MODEL_NAME)
+    except Exception as e:
+        st.error(f"Geminiモデルの読み込みに失敗しました: {e}")
+        st.stop()
+
+# ストリーミング中に途中表示を更新する最短の間隔 (秒)
+STREAM_RENDER_INTERVAL = 0.1
+
+# プロンプトの固定部分 (指示文) のキャッシュ (GEMINI_PREFIX_CACHE で切り替え)
+prefix_cache = get_prefix_cache(MODEL_NAME)
+
+# Gemini の呼び出しはすべて共有スケジューラを通す (レート制限・再試行・優先度・重複の合流)
+scheduler = get_scheduler()
+
+def run_scheduled(call, priority, coalesce_key=None, metrics=NULL_METRICS):
+    started = time.perf_counter()
+    request = scheduler.submit(call, priority=priority, coalesce_key=coalesce_key)
+    status_placeholder = st.empty()
+    while not request.wait(timeout=0.5):
+        position = scheduler.position(request)
+        if position:
+            status_placeholder.caption(f"混み合っています。順番待ち中です（{position}番目、{request.wait_seconds:.0f}秒経過）")
+        else:
+            status_placeholder.caption("Geminiが処理中です...")
+    status_placeholder.empty()
+    # 待ち行列での待ち時間と、Gemini側の処理時間を分けて記録する
+    metrics.add_stage("queue", request.wait_seconds)
+    metrics.add_stage("generate", time.perf_counter() - started - request.wait_seconds)
+    metrics.record("attempts", request.attempts)
+    return request.result()
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="プログラミング学習サポート", layout="wide")
 st.title("プログラミング学習サポート")
 st.caption("Gemini API を活用した学習アプリ") # Supabaseは未使用なので削除
 
+# 同じ依頼への回答を再利用するキャッシュ (全セッションで共有)
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    return ResponseCache()
+
+response_cache = get_response_cache()
+
+# 回答本体は圧縮してセッションストアに1度だけ保存し、session_state にはハンドルだけを置く
+@st.cache_resource(show_spinner=False)
+def get_session_store():
+    return SessionStore()
+
+session_store = get_session_store()
+if "session_store_id" not in st.session_state:
+    st.session_state.session_store_id = uuid.uuid4().hex
+session_store.touch(st.session_state.session_store_id)
+
+def load_gemini_response():
+    return session_store.load_response(st.session_state.get("response_handle"))
+
+def load_explanation():
+    return session_store.load_explanation(st.session_state.get("response_handle"))
+
+# 計測結果の書き出し先 (APP_METRICS=1 のときだけファイルに書く)
+@st.cache_resource(show_spinner=False)
+def get_metrics_sink():
+    return MetricsSink()
+
+def finish_metrics(metrics):
+    if not metrics.enabled:
+        return
+    st.session_state.last_metrics = metrics.to_dict()
+    if export_enabled():
+        get_metrics_sink().write(metrics)
+
 # --- サイドバー: ユーザー入力 (フォーム化) ---
 # クリアボタンはフォームの外に配置
 if st.sidebar.button("結果をクリア"):
+    session_store.release_session(st.session_state.session_store_id)
     keys_to_delete = [
-        'gemini_response', 'explanation', 'quiz_question', 'quiz_active',
-        'quiz_evaluated', 'user_name', 'selected_language', 'selected_goal',
+        'response_handle', 'quiz_question', 'quiz_active',
+        'quiz_evaluated', 'quiz_answer_key', 'last_metrics', 'followup_chat', 'user_name', 'selected_language', 'selected_goal',
         'selected_level', 'problem_details', 'uploaded_file_info' # 必要に応じてクリアする項目を追加
         ]
     for key in keys_to_delete:
@@ -50,15 +130,15 @@ with st.sidebar:
         st.text_input("お名前 (任意):", key="user_name", value=st.session_state.get("user_name", ""))
 
         # 言語選択
-        languages = ["Python", "HTML", "CSS", "JavaScript", "SQL"]
+        languages = LANGUAGES
         st.selectbox("学習したい言語を選択してください:", languages, key="selected_language", index=languages.index(st.session_state.get("selected_language", "Python")))
 
         # 目的選択
-        goals = ["困りごとの解決", "プログラミング学習"]
+        goals = GOALS
         st.selectbox("目的を選択してください:", goals, key="selected_goal", index=goals.index(st.session_state.get("selected_goal", "プログラミング学習")))
 
         # 技術レベル選択
-        levels = ["初学者", "何となくコードを読める", "自分でコーディングできる", "自力でバグ解消できる"]
+        levels = LEVELS
         st.selectbox("現在の技術レベルを選択してください:", levels, key="selected_level", index=levels.index(st.session_state.get("selected_level", "初学者")))
 
         # --- 困りごと入力 (Ctrl+Enterで送信期待) ---
@@ -70,142 +150,109 @@ with st.sidebar:
             "json", "yaml", "toml", "ini", "xml", "csv",
             "xhtml", "htm", "mjs", "cjs", "ipynb"
             ]
+        # 複数ファイルや .zip (中のファイルも上の拡張子だけを読み込む) もアップロードできる
         st.file_uploader(
-            f"関連するテキストファイルをアップロード (任意):",
-            type=allowed_text_extensions,
+            f"関連するテキストファイルまたは .zip をアップロード (任意・複数可):",
+            type=allowed_text_extensions + ["zip"],
+            accept_multiple_files=True,
             key="uploaded_file_info" # file_uploader自体もキーで状態管理
         )
 
+        # 回答を生成しながら少しずつ表示する (ストリーミング)
+        st.checkbox("回答を生成しながら表示する", key="stream_response", value=st.session_state.get("stream_response", True))
+
+        # 同じ依頼でも保存済みの回答を使わず、新しく生成したい場合
+        st.checkbox("保存済みの回答を使わずに新しく生成する", key="bypass_cache", value=False)
+
         # --- 実行ボタン (フォーム送信) ---
         submit_button = st.form_submit_button("実行する")
 
-# --- メイン画面: 結果表示 ---
+    cache_stats = response_cache.stats()
+    st.caption(f"回答キャッシュ: {cache_stats['entries']}件 (ヒット {cache_stats['hits']} / ミス {cache_stats['misses']})")
+    scheduler_stats = scheduler.stats()
+    st.caption(f"Gemini待ち行列: {scheduler_stats['queue_depth']}件 (平均待ち時間 {scheduler_stats['average_wait_seconds']:.1f}秒)")
 
-# クイズ抽出関数 (変更なし)
-def extract_quiz(response_text):
-    # ... (前回のコードと同じ) ...
-    lines = response_text.strip().split('\n')
-    quiz_question = None
-    explanation_lines = []
-    quiz_pattern = re.compile(r"^(Q:|質問:|問題:|クイズ：)\s*", re.IGNORECASE)
-    found_quiz = False
-    temp_explanation = []
-    for i, line in enumerate(lines):
-        stripped_line = line.strip()
-        if quiz_pattern.match(stripped_line):
-             quiz_question = line
-             found_quiz = True
-             explanation_lines.extend(temp_explanation)
-             temp_explanation = []
-        elif found_quiz:
-             pass
-        else:
-             temp_explanation.append(line)
-    if not found_quiz:
-        explanation_lines.extend(temp_explanation)
-    explanation_text = "\n".join(explanation_lines).strip()
-    if found_quiz and not explanation_text:
-         q_index = -1
-         for i, line in enumerate(lines):
-              if quiz_pattern.match(line.strip()):
-                   q_index = i
-                   break
-         if q_index > 0:
-             explanation_text = "\n".join(lines[:q_index]).strip()
-         else:
-             explanation_text = ""
-    if not quiz_question:
-        explanation_text = response_text.strip()
-    return explanation_text, quiz_question
+    # 処理時間やトークン数の診断情報 (有効なときだけ計測する)
+    st.checkbox("診断情報を表示", key="show_diagnostics", value=False)
+    diagnostics_placeholder = st.empty()
 
+metrics_enabled = st.session_state.get("show_diagnostics", False) or export_enabled()
+request_metrics = NULL_METRICS
+
+# --- メイン画面: 結果表示 ---
 
 # --- フォーム送信時 (実行ボタン押下時) の処理 ---
 if submit_button:
-    # --- ファイル処理ロジック (変更なし) ---
-    file_content = None
-    file_info = ""
-    encoding_used = None
-    process_file = True
+    request_metrics = start_request("explanation", metrics_enabled)
+    # --- ファイル処理ロジック ---
+    # 複数ファイルや .zip は upload_batch で展開し、デコードはスレッドプールで並列に行う
+    # (デコード自体は file_decoding に任せ、同じファイルの再送信ではデコード済みの結果を再利用)
+    file_info_lines = []
+    batch_files = []
+    loaded_files = []
+    # 読み込めたファイルごとの file_info_lines の位置 (注記を付ける行を特定するため)
+    loaded_info_indexes = []
     # サイドバーのフォームから値を取得
-    uploaded_file = st.session_state.get("uploaded_file_info") # キーを使って取得
-
-    if uploaded_file is not None:
-        file_name = uploaded_file.name
-        file_size = uploaded_file.size
-        st.write(f"アップロードされたファイル: `{file_name}` ({file_size / 1024:.1f} KB)")
-        file_info = f"ファイル名: {file_name}"
+    uploaded_files = st.session_state.get("uploaded_file_info") or [] # キーを使って取得
 
+    if uploaded_files:
         try:
-            if file_name.endswith(".ipynb"):
-                # ... (ipynb処理、変更なし) ...
-                file_info += " (.ipynb)"
-                try:
-                    uploaded_file.seek(0)
-                    notebook_content = uploaded_file.getvalue().decode("utf-8")
-                    notebook = json.loads(notebook_content)
-                    code_cells = [cell['source'] for cell in notebook.get('cells', []) if cell.get('cell_type') == 'code']
-                    file_content = "\n\n".join(["".join(cell) for cell in code_cells])
-                    encoding_used = "utf-8 (ipynb code cells)"
-                    st.text_area("抽出されたコードセル (.ipynb)", file_content, height=150, key="disp_ipynb_code") # 表示用ウィジェットにも固有キー推奨
-                except (json.JSONDecodeError, UnicodeDecodeError) as e_ipynb_parse:
-                    st.warning(f".ipynbファイルの解析またはUTF-8デコードに失敗しました ({e_ipynb_parse})。ファイル全体をテキストとして扱います。")
-                    try:
-                        uploaded_file.seek(0)
-                        try:
-                           file_content = uploaded_file.getvalue().decode("utf-8")
-                           encoding_used = "utf-8 (ipynb raw)"
-                        except UnicodeDecodeError:
-                           uploaded_file.seek(0)
-                           file_content = uploaded_file.getvalue().decode("shift-jis")
-                           encoding_used = "shift-jis (ipynb raw)"
-                           st.info(".ipynbファイルをShift-JISとして読み込みました(RAW)。")
-                        st.text_area("ファイルの内容 (.ipynb - RAW)", file_content, height=150, key="disp_ipynb_raw")
-                    except UnicodeDecodeError:
-                         st.error(f".ipynbファイル(RAW)はUTF-8またはShift-JISとしてデコードできませんでした。")
-                         file_info += " (RAWデコード失敗)"
-                         file_content = None; process_file = False
-                    except Exception as e_ipynb_raw:
-                         st.error(f".ipynbファイル(RAW)の処理中にエラー: {e_ipynb_raw}")
-                         file_info += " (RAW処理エラー)"
-                         file_content = None; process_file = False
-                except Exception as e_ipynb_other:
-                    st.error(f".ipynb ファイルの処理中に予期せぬエラーが発生しました: {e_ipynb_other}")
-                    file_info += " (処理エラー)"
-                    file_content = None; process_file = False
-            else:
-                # ... (その他のテキストファイル処理、変更なし) ...
-                uploaded_file.seek(0)
-                file_bytes = uploaded_file.getvalue()
-                try:
-                    file_content = file_bytes.decode("utf-8")
-                    encoding_used = "utf-8"
-                except UnicodeDecodeError:
-                    try:
-                        file_content = file_bytes.decode("shift-jis")
-                        encoding_used = "shift-jis"
-                        st.info(f"ファイル '{file_name}' はShift-JISとして読み込まれました。")
-                    except UnicodeDecodeError:
-                        st.error(f"ファイル '{file_name}' はUTF-8またはShift-JISとしてデコードできませんでした。")
-                        file_info += " (テキスト変換不可)"
-                        file_content = None; process_file = False
-                    except Exception as e_sjis:
-                         st.error(f"Shift-JISデコード中に予期せぬエラー: {e_sjis}")
-                         file_info += " (Shift-JISデコードエラー)"
-                         file_content = None; process_file = False
+            with request_metrics.stage("decode"), ExitStack() as file_buffers:
+                uploads = [
+                    (uploaded_file.name, file_buffers.enter_context(uploaded_file.getbuffer()))
+                    for uploaded_file in uploaded_files
+                ]
+                entries, skipped_files = expand_uploads(uploads, allowed_text_extensions)
+                batch_files = load_files(entries) + skipped_files
+            request_metrics.record("file_bytes", sum(uploaded_file.size for uploaded_file in uploaded_files))
+            request_metrics.record("file_count", len(batch_files))
         except Exception as e_outer:
              st.error(f"ファイル処理中に予期せぬエラーが発生しました: {e_outer}")
-             file_info += " (不明なエラー)"
-             file_content = None; process_file = False
-
-        if process_file and file_content is not None:
-            # ... (文字数制限チェック、変更なし) ...
-            max_chars = 500000
-            if len(file_content) > max_chars:
-                st.error(f"ファイル '{file_name}' の文字数 ({len(file_content)}文字) が制限 ({max_chars}文字) を超えています。")
+             file_info_lines.append("ファイル: (不明なエラー)")
+             batch_files = []
+
+        for index, batch_file in enumerate(batch_files):
+            file_name = batch_file.name
+            decoded = batch_file.decoded
+            st.write(f"アップロードされたファイル: `{file_name}` ({batch_file.size / 1024:.1f} KB)")
+            file_info = f"ファイル名: {file_name}"
+            if file_name.endswith(".ipynb"):
+                file_info += " (.ipynb)"
+
+            if batch_file.status == "archive_error":
+                st.error(f"ファイル '{file_name}' は{batch_file.message}。")
+                continue
+            if batch_file.status == "skipped":
+                st.warning(f"ファイル '{file_name}' は{batch_file.message}。")
+                continue
+            if decoded is not None and decoded.notebook_error:
+                st.warning(f".ipynbファイルの解析またはUTF-8デコードに失敗しました ({decoded.notebook_error})。ファイル全体をテキストとして扱います。")
+            if batch_file.status == "decode_error":
+                if decoded.is_notebook:
+                    st.error(f".ipynbファイル(RAW)はUTF-8またはShift-JISとしてデコードできませんでした。")
+                    file_info += " (RAWデコード失敗)"
+                else:
+                    st.error(f"ファイル '{file_name}' はUTF-8またはShift-JISとしてデコードできませんでした。")
+                    file_info += " (テキスト変換不可)"
+            elif batch_file.status == "too_large":
+                # 文字数制限は1ファイルごとに確認する
+                st.error(f"ファイル '{file_name}' の{batch_file.message}。")
                 file_info += f" (文字数超過)"
-                file_content = None; process_file = False
             else:
-                 file_info += f" ({len(file_content)}文字, encoding: {encoding_used})"
+                file_content = decoded.text
+                encoding_used = decoded.encoding
+                if decoded.is_notebook and decoded.cells is not None:
+                    st.text_area("抽出されたコードセル (.ipynb)", file_content, height=150, key=f"disp_ipynb_code_{index}") # 表示用ウィジェットにも固有キー推奨
+                elif decoded.is_notebook:
+                    if encoding_used.startswith("shift-jis"):
+                        st.info(".ipynbファイルをShift-JISとして読み込みました(RAW)。")
+                    st.text_area("ファイルの内容 (.ipynb - RAW)", file_content, height=150, key=f"disp_ipynb_raw_{index}")
+                elif encoding_used == "shift-jis":
+                    st.info(f"ファイル '{file_name}' はShift-JISとして読み込まれました。")
+                file_info += f" ({len(file_content)}文字, encoding: {encoding_used})"
+                loaded_files.append(batch_file)
+                loaded_info_indexes.append(len(file_info_lines))
+            file_info_lines.append(file_info)
 
     # --- プロンプト生成とGemini呼び出し ---
     st.subheader("Geminiへの依頼内容")
@@ -217,87 +264,182 @@ if submit_button:
     selected_level = st.session_state.get("selected_level")
     problem_details = st.session_state.get("problem_details", "").strip()
 
-    # プロンプトの組み立て (順序変更、ユーザー名追加)
-    prompt_parts = []
-
-    # ユーザー名に応じた挨拶
-    if user_name:
-        prompt_parts.append(f"{user_name}さん、こんにちは！プログラミング学習AIです。")
-    else:
-        prompt_parts.append("プログラミング学習AIです。")
-
-    prompt_parts.append(f"あなたの現在の状況と言語、目的に合わせてサポートします。")
-    prompt_parts.append(f"対象言語: {selected_language}")
-    prompt_parts.append(f"目的: {selected_goal}")
-    prompt_parts.append(f"技術レベル: {selected_level}")
-
-    if problem_details:
-        prompt_parts.append(f"\n# {user_name}さんからの質問や困りごと:\n{problem_details}")
-    else:
-        # デフォルト指示 (変更なし)
-        if selected_goal == "困りごとの解決":
-             prompt_parts.append(f"\n# {user_name}さんからの具体的な質問:")
-             prompt_parts.append("具体的な困りごとが入力されていません。アップロードされたファイル情報（もしあれば）や選択された言語、レベルから想定される一般的な問題や、その言語の基本的な使い方について解説してください。")
-        elif selected_goal == "プログラミング学習":
-             prompt_parts.append(f"\n# {user_name}さんからの具体的な質問:")
-             prompt_parts.append(f"具体的な質問が入力されていません。{selected_language}の基本的な概念や、{selected_level}レベルのあなたが学び始めると良いトピックについて解説してください。")
-
-    # --- 目的別の指示 (ファイル情報より前に移動) ---
-    prompt_parts.append("\n# 回答生成のための指示:")
-    if selected_goal == "困りごとの解決":
-        prompt_parts.append("- ユーザーの質問や困りごと、提供されたファイル情報（もしあれば）に基づいて、具体的な解決策やコード例を提示してください。")
-        prompt_parts.append("- **重要:** 回答の最後に、参考文献として役立つ可能性のあるWebサイトのURLを必ず3つから5つ提示してください。リスト形式などが望ましいです。")
-        prompt_parts.append("- 回答はマークダウン形式で、{user_name}さんが読みやすいように記述してください。".format(user_name=user_name if user_name else "ユーザー"))
-    elif selected_goal == "プログラミング学習":
-        prompt_parts.append(f"- {selected_language}の{selected_level}レベルの{user_name}さん向けに、質問やファイル情報（もしあれば）に関連する基本的な概念や書き方を解説してください。".format(user_name=user_name if user_name else "ユーザー"))
-        prompt_parts.append("- **重要:** 解説の最後に、内容の理解度を確認するための簡単なクイズを1つ作成してください。")
-        prompt_parts.append("- **クイズの形式:** 必ず応答の最後に、改行を挟んでから `Q: [質問文]` の形式で質問文のみを提示してください。")
-        prompt_parts.append("- **絶対に、絶対に、絶対にクイズの解答や正解を示唆するヒントをユーザー向けの出力に含めないでください。**")
-        prompt_parts.append("- 回答はマークダウン形式で、{user_name}さんが読みやすいように記述してください。".format(user_name=user_name if user_name else "ユーザー"))
-
-    prompt_parts.append("\n以下の追加情報も考慮してください。")
-
-    # ファイル情報と内容をプロンプトに追加 (指示の後)
-    if file_info:
-        prompt_parts.append(f"\n--- {user_name}さんが提供したファイル情報 ---")
-        prompt_parts.append(file_info)
-        if process_file and file_content is not None:
-             prompt_parts.append("\n--- ファイル内容 ---")
-             prompt_parts.append(file_content)
-             prompt_parts.append("--- ファイル内容ここまで ---")
-        prompt_parts.append("--- ファイル情報ここまで ---")
-
-
-    final_prompt = "\n".join(prompt_parts)
+    # --- ファイル内容をトークン上限内に縮める (プロンプト組み立ての前に行う) ---
+    file_context = None
+    file_text = None
+    if len(loaded_files) == 1:
+        single_file = loaded_files[0]
+        try:
+            with request_metrics.stage("context"):
+                file_context = build_file_context(single_file.name, single_file.text, problem_details, cells=single_file.decoded.cells)
+        except Exception as e:
+            st.error(f"ファイル '{single_file.name}' の内容をプロンプトに収められなかったため、ファイル名だけを送信します ({e})")
+            file_info_lines[loaded_info_indexes[0]] += " (内容は送信できませんでした)"
+        if file_context is not None:
+            request_metrics.record("file_tokens_original", file_context.original_tokens)
+            request_metrics.record("file_tokens_sent", file_context.kept_tokens)
+            file_text = file_context.text
+            if file_context.reduced:
+                file_info_lines[loaded_info_indexes[0]] += " (ファイルが大きいため、質問に関係しそうな部分のみ抜粋。省略箇所は「...」で表示)"
+                st.caption(
+                    f"ファイルが大きいため、関係しそうな部分だけを送信します: "
+                    f"約{file_context.original_tokens:,}トークン → 約{file_context.kept_tokens:,}トークン "
+                    f"({file_context.kept_ratio:.0%} を送信, 方式: {file_context.strategy})"
+                )
+            if len(batch_files) > 1:
+                # ほかのファイルを読み込めなかった場合も、どのファイルの内容かを build_batch_context と同じ形で示す
+                label = " (大きいため関係しそうな部分のみ抜粋)" if file_context.reduced else ""
+                file_text = f"### ファイル: {single_file.name}{label}\n{file_text}"
+    elif len(loaded_files) > 1:
+        # 配分に収まらない大きなファイルは、先にファイルごとに並列で要約する (map)
+        large_files = files_to_summarize(loaded_files)
+        if large_files:
+            model = load_model()
+
+            def submit_summary(summary_prompt, coalesce_key, max_output_tokens):
+                summary_config = {"max_output_tokens": max_output_tokens}
+                return scheduler.submit(
+                    lambda: model.generate_content(summary_prompt, generation_config=summary_config).text,
+                    priority=PRIORITY_BACKGROUND, coalesce_key=coalesce_key,
+                )
+
+            with request_metrics.stage("summarize"), st.spinner(f"大きなファイル ({len(large_files)}件) を要約しています..."):
+                summary_errors = summarize_files(large_files, submit_summary, cache=response_cache, model_name=MODEL_NAME)
+            request_metrics.record("files_summarized", len(large_files) - len(summary_errors))
+            for failed_name, error in summary_errors:
+                st.warning(f"ファイル '{failed_name}' の要約に失敗したため、関係しそうな部分の抜粋を送信します ({error})")
+        # 要約と小さいファイルの内容を1つにまとめる (reduce)
+        try:
+            with request_metrics.stage("context"):
+                file_context = build_batch_context(loaded_files, problem_details)
+        except Exception as e:
+            st.error(f"ファイルの内容をプロンプトに収められなかったため、ファイル名だけを送信します ({e})")
+        if file_context is not None:
+            file_text = file_context.text
+            request_metrics.record("file_tokens_original", file_context.original_tokens)
+            request_metrics.record("file_tokens_sent", file_context.kept_tokens)
+            request_metrics.record("files_summary_used", len(file_context.summarized))
+            if file_context.reduced:
+                st.caption(
+                    f"ファイルが大きいため、一部を要約・抜粋して送信します: "
+                    f"約{file_context.original_tokens:,}トークン → 約{file_context.kept_tokens:,}トークン "
+                    f"(要約 {len(file_context.summarized)}件, 抜粋 {len(file_context.excerpted)}件)"
+                )
+    file_info = "\n".join(file_info_lines)
+
+    # プロンプトの組み立て
+    # 言語・目的・レベルで決まる指示部分は prompt_templates で組み立て済みのものを使い、
+    # 名前・質問・ファイルなどの可変部分だけを後ろにつなぐ
+    prompt_started = time.perf_counter()
+    prompt_template = get_template(selected_language, selected_goal, selected_level)
+    rendered_prompt = render_prompt(
+        prompt_template, user_name, problem_details, file_info, file_text,
+    )
+    final_prompt = rendered_prompt.text
+    request_metrics.add_stage("prompt", time.perf_counter() - prompt_started)
+    request_metrics.record("prompt_chars", len(final_prompt))
+    request_metrics.record("prefix_tokens", prompt_template.prefix_tokens)
+
+    def generate_answer(model, stream=False):
+        # 固定部分がキャッシュ済みなら、可変部分だけを送る
+        lookup = prefix_cache.prepare(prompt_template, model)
+        contents = final_prompt if lookup.send_prefix else rendered_prompt.suffix
+        return lookup, lookup.model.generate_content(contents, stream=stream)
+
+    def record_prompt_usage(lookup, response):
+        usage_metadata = getattr(response, "usage_metadata", None)
+        request_metrics.record_usage(usage_metadata)
+        if request_metrics.enabled:
+            request_metrics.record(
+                "cached_token_ratio",
+                cached_token_ratio(lookup, usage_metadata, estimate_tokens(final_prompt)),
+            )
 
     with st.expander("Geminiに送信するプロンプト（確認用）"):
         st.text(final_prompt)
 
     # --- 2. Gemini API呼び出し ---
     st.subheader("Geminiからの回答")
+    cache_key = make_cache_key(final_prompt, MODEL_NAME)
+    cached_response_text = None
+    if not st.session_state.get("bypass_cache", False):
+        cached_response_text = response_cache.get(cache_key)
+    request_metrics.record("cache_hit", cached_response_text is not None)
     try:
-        with st.spinner("Geminiが回答を生成中です..."):
-            response = model.generate_content(final_prompt)
-            gemini_response_text = response.text
-            explanation_text, quiz_question = extract_quiz(gemini_response_text)
-            # 結果をセッション状態に保存
-            st.session_state.gemini_response = gemini_response_text
-            st.session_state.explanation = explanation_text
-            st.session_state.quiz_question = quiz_question
-            st.session_state.quiz_active = (selected_goal == "プログラミング学習" and quiz_question is not None)
-            st.session_state.quiz_evaluated = False
+        if cached_response_text is not None:
+            # 同じ依頼の回答が保存されていれば、Geminiを呼ばずにそれを使う
+            st.caption("以前の同じ依頼に対する保存済みの回答を表示しています。")
+            raw_response_text = cached_response_text
+            with request_metrics.stage("parse"):
+                gemini_response_text, explanation_text, quiz_question, answer_key = parse_response(raw_response_text)
+        elif st.session_state.get("stream_response", True):
+            model = load_model()
+            # ストリーミング: チャンクを受信するたびに解説部分だけを表示する
+            # (クイズ行や解答キーを検出した時点で表示を止めるので、解説には混ざらない)
+            stream_placeholder = st.empty()
+            stream_placeholder.info("Geminiが回答を生成中です...")
+            extractor = StreamingQuizExtractor()
+            # ストリームの開始 (最初のチャンクの受信) までをスケジューラで管理する
+            prefix_lookup, response = run_scheduled(lambda: generate_answer(model, stream=True), PRIORITY_EXPLANATION, metrics=request_metrics)
+            request_metrics.mark("first_chunk_seconds")
+            with request_metrics.stage("stream"):
+                # 途中表示の更新は一定間隔ごとにまとめる (チャンクごとに全文を送り直さない)
+                last_render = 0.0
+                for chunk in response:
+                    if extractor.feed(chunk.text) and time.perf_counter() - last_render >= STREAM_RENDER_INTERVAL:
+                        visible_text = extractor.visible_text()
+                        if visible_text:
+                            stream_placeholder.markdown(visible_text)
+                            last_render = time.perf_counter()
+            record_prompt_usage(prefix_lookup, response)
+            raw_response_text = extractor.full_text
+            with request_metrics.stage("parse"):
+                gemini_response_text, explanation_text, quiz_question, answer_key = extractor.finish()
+            # 最終的な解説は下の「回答表示」で描画するため、途中表示は消しておく
+            stream_placeholder.empty()
+        else:
+            model = load_model()
+            with st.spinner("Geminiが回答を生成中です..."):
+                prefix_lookup, response = run_scheduled(lambda: generate_answer(model), PRIORITY_EXPLANATION, coalesce_key=cache_key, metrics=request_metrics)
+                request_metrics.mark("first_chunk_seconds")
+                record_prompt_usage(prefix_lookup, response)
+                raw_response_text = response.text
+                with request_metrics.stage("parse"):
+                    gemini_response_text, explanation_text, quiz_question, answer_key = parse_response(raw_response_text)
+        request_metrics.record("response_chars", len(raw_response_text))
+        if cached_response_text is None:
+            response_cache.put(cache_key, raw_response_text)
+        # 結果をセッション状態に保存 (ストリーミング/一括のどちらでも同じ内容になる)
+        # 前回の回答は不要になるので解放してから保存する
+        session_store.release_session(st.session_state.session_store_id)
+        st.session_state.response_handle = session_store.save_response(
+            st.session_state.session_store_id, gemini_response_text, explanation_text
+        )
+        st.session_state.quiz_question = quiz_question
+        # 解答キーは表示用のクイズとは別に保持し、採点にだけ使う
+        st.session_state.quiz_answer_key = answer_key
+        st.session_state.quiz_active = (selected_goal == "プログラミング学習" and quiz_question is not None)
+        st.session_state.quiz_evaluated = False
+        # フォローアップの会話は、最初の依頼と回答 (解答キーは除く) を共有の文脈として始める
+        prompt_blob_id = session_store.put_text(st.session_state.session_store_id, final_prompt)
+        st.session_state.followup_chat = FollowUpChat(prompt_blob_id, st.session_state.response_handle.blob_id)
     except Exception as e:
+        request_metrics.record("error", type(e).__name__)
         st.error(f"Gemini APIの呼び出し中にエラーが発生しました: {e}")
-        st.session_state.gemini_response = None
-        st.session_state.explanation = None
+        st.session_state.response_handle = None
         st.session_state.quiz_question = None
+        st.session_state.quiz_answer_key = None
         st.session_state.quiz_active = False
+        st.session_state.followup_chat = None
 
 
 # --- 3. 回答表示とインタラクション ---
 # 解説表示
-if 'explanation' in st.session_state and st.session_state.explanation:
-    st.markdown(st.session_state.explanation)
+explanation = load_explanation()
+if explanation:
+    with request_metrics.stage("render"):
+        st.markdown(explanation)
+finish_metrics(request_metrics)
 
 # --- クイズ表示・採点 (フォーム化) ---
 if 'quiz_active' in st.session_state and st.session_state.quiz_active:
@@ -313,38 +455,132 @@ if 'quiz_active' in st.session_state and st.session_state.quiz_active:
 
             if submit_quiz_button: # フォーム送信時に処理
                 if user_answer:
-                    # 採点プロンプト生成 (元の応答全体を使用)
-                    evaluation_prompt = f"""
+                    grading_metrics = start_request("grading", metrics_enabled)
+                    answer_key = st.session_state.get("quiz_answer_key")
+                    user_label = st.session_state.get('user_name', '不明')
+                    # 正規化して一致するような明らかな解答は、APIを呼ばずにその場で採点する
+                    with grading_metrics.stage("local_grade"):
+                        local_grade = grade_locally(user_answer, answer_key)
+                    grading_metrics.record("local", local_grade is not None)
+                    if local_grade is not None:
+                        st.markdown("---")
+                        st.subheader("採点結果")
+                        st.markdown(local_grade.feedback)
+                        st.session_state.quiz_evaluated = True
+                    else:
+                        if answer_key:
+                            # 解答キーがあれば、解説全文ではなくクイズと採点基準だけを送る
+                            evaluation_prompt = build_grading_prompt(st.session_state.quiz_question, answer_key, user_answer, user_label)
+                        else:
+                            # 解答キーがない場合は従来どおり元の応答全体を使用
+                            evaluation_prompt = f"""
                     あなたはプログラミングクイズの採点者です。
-                    以下の「元の解説とクイズ」と「ユーザー ({st.session_state.get('user_name', '不明')}) の解答」を比較し、ユーザーの解答がクイズの意図に合っているか、正解と言えるかを判断してください。
+                    以下の「元の解説とクイズ」と「ユーザー ({user_label}) の解答」を比較し、ユーザーの解答がクイズの意図に合っているか、正解と言えるかを判断してください。
                     判断結果と、簡単な解説（なぜ正解/不正解なのか、正解の考え方など）をユーザーにフィードバックしてください。
 
                     **重要:** 元の解説に仮に正解が記載されていたとしても、その正解自体を直接ユーザーへのフィードバックに記述しないでください。あくまでユーザーの解答に対する評価と、正解に至る考え方を説明するに留めてください。
 
                     # 元の解説とクイズ:
-                    {st.session_state.get('gemini_response', '（元の応答がありません）')}
+                    {load_gemini_response() or '（元の応答がありません）'}
 
-                    # ユーザー ({st.session_state.get('user_name', '不明')}) の解答:
+                    # ユーザー ({user_label}) の解答:
                     {user_answer}
 
                     # フィードバック形式（例）:
                     - **採点結果:** 正解です！ / 惜しい！もう少しです / 不正解です
                     - **解説:** [なぜその評価なのか、正解の考え方などを簡潔に記述]
                     """
-                    try:
-                        with st.spinner("採点中です..."):
-                            evaluation_response = model.generate_content(evaluation_prompt)
-                            st.markdown("---")
-                            st.subheader("採点結果")
-                            st.markdown(evaluation_response.text)
-                            st.session_state.quiz_evaluated = True
-                    except Exception as e:
-                        st.error(f"採点中にエラーが発生しました: {e}")
+                        grading_metrics.record("prompt_chars", len(evaluation_prompt))
+                        model = load_model()
+                        try:
+                            with st.spinner("採点中です..."):
+                                evaluation_response = run_scheduled(
+                                    lambda: model.generate_content(evaluation_prompt), PRIORITY_GRADING,
+                                    coalesce_key=make_cache_key(evaluation_prompt, MODEL_NAME),
+                                    metrics=grading_metrics,
+                                )
+                                grading_metrics.record_usage(getattr(evaluation_response, "usage_metadata", None))
+                                st.markdown("---")
+                                st.subheader("採点結果")
+                                st.markdown(evaluation_response.text)
+                                st.session_state.quiz_evaluated = True
+                        except Exception as e:
+                            grading_metrics.record("error", type(e).__name__)
+                            st.error(f"採点中にエラーが発生しました: {e}")
+                    finish_metrics(grading_metrics)
                 else:
                     st.warning("クイズの答えを入力してください。") # フォーム送信時に未入力の場合
 
 # クイズがない場合のメッセージ表示
-elif 'gemini_response' in st.session_state and st.session_state.get("selected_goal") == "プログラミング学習":
+elif st.session_state.get("response_handle") is not None and st.session_state.get("selected_goal") == "プログラミング学習":
      if not ('quiz_question' in st.session_state and st.session_state.quiz_question):
-         if 'explanation' in st.session_state and st.session_state.explanation:
-              st.info("今回の回答にはクイズ形式の問題が含まれていないようです。")
\ No newline at end of file
+         if explanation:
+              st.info("今回の回答にはクイズ形式の問題が含まれていないようです。")
+
+# --- 続けて質問する (フォローアップ) ---
+# 最初の依頼と回答を共有したまま、新しい質問だけをチャットとして送る
+followup_chat = st.session_state.get("followup_chat")
+if followup_chat is not None and explanation:
+    st.markdown("---")
+    st.subheader("続けて質問する")
+    transcript = st.container()
+    with st.form(key="followup_form", clear_on_submit=True):
+        followup_question = st.text_area("回答やファイルについて、続けて質問できます:", key="followup_input", height=100)
+        submit_followup = st.form_submit_button("質問する")
+
+    if submit_followup and followup_question.strip():
+        followup_metrics = start_request("followup", metrics_enabled)
+        question = followup_question.strip()
+        # 前回までに終わった履歴の要約を取り込んでから、履歴を組み立てる
+        with followup_metrics.stage("history"):
+            followup_chat.prepare_turn()
+            history = followup_chat.build_history(session_store.get_text)
+        if history is None:
+            st.error("元の回答が見つかりませんでした。もう一度「実行する」から依頼してください。")
+        else:
+            followup_metrics.record("history_tokens", followup_chat.history_tokens)
+            model = load_model()
+            try:
+                with st.spinner("Geminiが回答を生成中です..."):
+                    followup_response = run_scheduled(
+                        lambda: model.start_chat(history=history).send_message(question),
+                        PRIORITY_EXPLANATION, metrics=followup_metrics,
+                    )
+                followup_metrics.record_usage(getattr(followup_response, "usage_metadata", None))
+                followup_chat.add_turn(question, followup_response.text)
+                # 履歴が上限を超えたら、古いやり取りの要約をバックグラウンドで始めておく
+                compaction_config = {"max_output_tokens": CHAT_SUMMARY_MAX_OUTPUT_TOKENS}
+                followup_chat.start_compaction(lambda compaction_prompt: scheduler.submit(
+                    lambda: model.generate_content(compaction_prompt, generation_config=compaction_config).text,
+                    priority=PRIORITY_BACKGROUND,
+                ))
+            except Exception as e:
+                followup_metrics.record("error", type(e).__name__)
+                st.error(f"Gemini APIの呼び出し中にエラーが発生しました: {e}")
+        finish_metrics(followup_metrics)
+
+    with transcript:
+        if followup_chat.summarized_turns:
+            st.caption(f"これより前のやり取り ({followup_chat.summarized_turns}件) は要約して引き継いでいます。")
+        for turn in followup_chat.turns:
+            with st.chat_message("user"):
+                st.markdown(turn.question)
+            with st.chat_message("assistant"):
+                st.markdown(turn.answer)
+
+# --- 診断情報 (サイドバー) ---
+# 今回の実行で記録した内容も表示できるよう、スクリプトの最後で描画する
+if st.session_state.get("show_diagnostics", False):
+    with diagnostics_placeholder.container():
+        with st.expander("診断情報", expanded=True):
+            last_metrics = st.session_state.get("last_metrics")
+            if last_metrics:
+                st.caption(f"直近のリクエスト ({last_metrics['kind']}): 合計 {last_metrics['total_seconds']:.2f}秒")
+                st.table({"処理時間 (秒)": last_metrics["stages"]})
+                st.json(last_metrics["values"])
+            else:
+                st.caption("まだ計測したリクエストはありません。")
+            st.caption(f"回答キャッシュ: {response_cache.stats()}")
+            st.caption(f"スケジューラ: {scheduler.stats()}")
+            st.caption(f"プロンプト固定部分のキャッシュ: {prefix_cache.stats()}")
+            st.caption(f"セッションストア: {session_store.stats()}")
@@ -0,0 +1,96 @@
+"""アップロードファイルのデコード処理の時間とピークメモリを測定する。
+
+従来の処理 (getvalue() を繰り返し呼び、.ipynb は json.loads で全体を読み込む) と
+file_decoding.decode_upload を、50万文字程度の入力で比較する。
+
+使い方 (リポジトリのルートで実行):
+    python benchmarks/bench_decoding.py
+"""
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_decoding import clear_memo, decode_upload  # noqa: E402
+
+TARGET_CHARS = 500_000
+
+
+def make_inputs():
+    line = "def add(a, b):  # 足し算をする関数\n    return a + b\n"
+    text = (line * (TARGET_CHARS // len(line) + 1))[:TARGET_CHARS]
+    # コードセルの合計が約50万文字になるノートブック (出力の画像データも含む)
+    cells = []
+    code_chars = 0
+    while code_chars < TARGET_CHARS:
+        source = [f"x = {len(cells)}\n", "print(x)  # 確認\n"] * 20
+        code_chars += sum(len(s) for s in source)
+        cells.append({
+            "cell_type": "code",
+            "source": source,
+            "outputs": [{"output_type": "display_data", "data": {"image/png": "iVBORw0KGgo" * 200}}],
+            "metadata": {},
+        })
+        cells.append({"cell_type": "markdown", "source": ["## メモ\n"] * 10, "metadata": {}})
+    notebook = json.dumps({"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 5}, ensure_ascii=False)
+    return {
+        "utf-8 .py": ("sample.py", text.encode("utf-8")),
+        "shift-jis .txt": ("sample.txt", text.encode("shift-jis")),
+        "ipynb": ("sample.ipynb", notebook.encode("utf-8")),
+    }
+
+
+def legacy_decode(file_name, data):
+    # 変更前の app.py と同じ手順
+    uploaded_file = io.BytesIO(data)
+    if file_name.endswith(".ipynb"):
+        uploaded_file.seek(0)
+        notebook = json.loads(uploaded_file.getvalue().decode("utf-8"))
+        code_cells = [cell['source'] for cell in notebook.get('cells', []) if cell.get('cell_type') == 'code']
+        return "\n\n".join(["".join(cell) for cell in code_cells])
+    uploaded_file.seek(0)
+    file_bytes = uploaded_file.getvalue()
+    try:
+        return file_bytes.decode("utf-8")
+    except UnicodeDecodeError:
+        return file_bytes.decode("shift-jis")
+
+
+def measure(func, *args, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def decode_without_memo(file_name, data):
+    clear_memo()
+    return decode_upload(file_name, data)
+
+
+def main():
+    print(f"{'input':16s} {'method':14s} {'time (ms)':>10s} {'peak (MB)':>10s}")
+    for label, (file_name, data) in make_inputs().items():
+        assert legacy_decode(file_name, data) == decode_without_memo(file_name, data).text
+        decode_upload(file_name, data)
+        for method, func in (
+            ("legacy", legacy_decode),
+            ("decode_upload", decode_without_memo),
+            ("memoized", decode_upload),
+        ):
+            seconds, peak = measure(func, file_name, data)
+            print(f"{label:16s} {method:14s} {seconds * 1000:10.2f} {peak / 1024 / 1024:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
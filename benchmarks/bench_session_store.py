@@ -0,0 +1,79 @@
+"""N個のセッションが回答を保持したときのメモリ使用量を比較する。
+
+変更前と同じく session_state に回答全文と解説 (ほぼ同じ内容) を文字列で持つ場合と、
+SessionStore にハンドルだけを持たせる場合を、tracemalloc で測定する。
+回答の一部は「同じ依頼への同じ回答」として複数のセッションで共通になるようにしている。
+
+使い方 (リポジトリのルートで実行):
+    python benchmarks/bench_session_store.py [セッション数]
+"""
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quiz import parse_response  # noqa: E402
+from session_store import SessionStore  # noqa: E402
+
+
+def make_response(seed):
+    rng = random.Random(seed)
+    paragraphs = []
+    for i in range(40):
+        words = " ".join(rng.choice(["変数", "関数", "リスト", "ループ", "条件分岐", "print", "for", "if"]) for _ in range(30))
+        paragraphs.append(f"## ポイント{i}\n{words}\n```python\nfor i in range({i}):\n    print(i)\n```")
+    return "\n\n".join(paragraphs) + "\n\nQ: 上のコードは何回出力しますか？\n"
+
+
+def simulate_raw(responses):
+    sessions = {}
+    for session_id, response in enumerate(responses):
+        _, explanation, quiz_question, _ = parse_response(response)
+        sessions[session_id] = {"gemini_response": response, "explanation": explanation, "quiz_question": quiz_question}
+    return sessions
+
+
+def simulate_store(responses, store):
+    sessions = {}
+    for session_id, response in enumerate(responses):
+        visible, explanation, quiz_question, _ = parse_response(response)
+        handle = store.save_response(session_id, visible, explanation)
+        sessions[session_id] = {"response_handle": handle, "quiz_question": quiz_question}
+    return sessions
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    result = func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak
+
+
+def main():
+    session_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    # 同じ依頼が多いため、回答の種類はセッション数の1/5とする
+    distinct = [make_response(seed) for seed in range(max(1, session_count // 5))]
+    responses = [distinct[i % len(distinct)] for i in range(session_count)]
+    # 共有されない状態を再現するため、文字列はセッションごとに別オブジェクトにする
+    responses = ["".join(list(response)) for response in responses]
+
+    _, raw_current, raw_peak = measure(simulate_raw, responses)
+    with tempfile.TemporaryDirectory() as directory:
+        store = SessionStore(os.path.join(directory, "store.sqlite3"), memory_limit=4 * 1024 * 1024)
+        sessions, store_current, store_peak = measure(simulate_store, responses, store)
+        stats = store.stats()
+        assert store.load_explanation(sessions[0]["response_handle"]) == parse_response(responses[0])[1]
+
+    print(f"sessions: {session_count}, distinct responses: {len(distinct)}, response size: {len(responses[0]):,} chars")
+    print(f"{'method':16s} {'retained (MB)':>14s} {'peak (MB)':>10s}")
+    print(f"{'session_state':16s} {raw_current / 1024 / 1024:14.2f} {raw_peak / 1024 / 1024:10.2f}")
+    print(f"{'SessionStore':16s} {store_current / 1024 / 1024:14.2f} {store_peak / 1024 / 1024:10.2f}")
+    print(f"store stats: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""起動時の import 時間と、再実行 (rerun) 1回あたりの時間を測定する。
+
+使い方 (リポジトリのルートで実行):
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --ref 92a78d0 --ref HEAD   # 指定したコミットの app.py どうしを比べる
+
+--ref を指定すると、そのコミットの内容を一時ディレクトリに取り出して測定する (作業ツリーは変更しない)。
+測定はすべて別プロセスで行うので、ツリーごとのモジュールが混ざらない。
+APIキーは実際には使わないため、ダミーの値で測定する。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_rerun_code = """
+import json, os, statistics, sys, time
+from streamlit.testing.v1 import AppTest
+
+at = AppTest.from_file(os.path.join(os.getcwd(), "app.py"), default_timeout=30)
+start = time.perf_counter()
+at.run()
+first_run = time.perf_counter() - start
+samples = []
+for _ in range({repeat}):
+    start = time.perf_counter()
+    at.run()
+    samples.append(time.perf_counter() - start)
+print(json.dumps([first_run, statistics.median(samples)]))
+"""
+
+
+def _run_python(code, cwd):
+    env = dict(os.environ)
+    env.setdefault("GOOGLE_API_KEY", "dummy-key-for-benchmark")
+    env["PYTHONPATH"] = cwd
+    out = subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    return out.stdout.strip().splitlines()[-1]
+
+
+def measure_import(module_name, repeat=5, app_dir=REPO_ROOT):
+    # 毎回新しいプロセスで import し、コールドスタートに近い時間を測る
+    if "." not in module_name and not os.path.exists(os.path.join(app_dir, f"{module_name}.py")):
+        # 指定したコミットにまだないモジュール
+        return None
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module_name}; "
+        "print(time.perf_counter() - start)"
+    )
+    return statistics.median(float(_run_python(code, app_dir)) for _ in range(repeat))
+
+
+def measure_rerun(repeat=20, app_dir=REPO_ROOT):
+    """(新しいプロセスでの最初の実行の時間, その後の再実行の中央値) を返す。"""
+    first_run, rerun = json.loads(_run_python(_rerun_code.format(repeat=repeat), app_dir))
+    return first_run, rerun
+
+
+def measure(app_dir, import_repeat=5, rerun_repeat=20):
+    first_run, rerun = measure_rerun(rerun_repeat, app_dir)
+    return {
+        "import google.generativeai (s)": measure_import("google.generativeai", import_repeat, app_dir),
+        "import gemini_client (s)": measure_import("gemini_client", import_repeat, app_dir),
+        "app.py first run (s)": first_run,
+        "app.py rerun median (s)": rerun,
+    }
+
+
+def export_ref(ref, directory):
+    """ref の時点のファイルを directory に取り出す。"""
+    archive = subprocess.run(["git", "archive", ref], cwd=REPO_ROOT, capture_output=True, check=True).stdout
+    subprocess.run(["tar", "-x", "-C", directory], input=archive, check=True)
+
+
+def _format(value):
+    return "-" if value is None else f"{value:.4f}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ref", action="append", default=[],
+                        help="測定する git のコミット (複数指定可)。省略時は作業ツリーを測定する")
+    parser.add_argument("--import-repeat", type=int, default=5)
+    parser.add_argument("--rerun-repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    columns = {}
+    if not args.ref:
+        columns["working tree"] = measure(REPO_ROOT, args.import_repeat, args.rerun_repeat)
+    for ref in args.ref:
+        with tempfile.TemporaryDirectory(prefix="bench-startup-") as directory:
+            export_ref(ref, directory)
+            columns[ref] = measure(directory, args.import_repeat, args.rerun_repeat)
+
+    names = list(next(iter(columns.values())))
+    print(f"{'':32s} " + " ".join(f"{label:>14s}" for label in columns))
+    for name in names:
+        print(f"{name:32s} " + " ".join(f"{_format(values[name]):>14s}" for values in columns.values()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""ネットワークを使わずにアプリを動かすための、google.generativeai の偽物。
+
+install() を呼ぶと sys.modules の google.generativeai が置き換わり、
+アプリは遅延 import の時点でこの偽物を読み込む。応答までの時間・ストリーミングの
+チャンク間隔・応答の長さは FakeConfig で変更できる。
+"""
+import sys
+import threading
+import time
+import types
+from dataclasses import dataclass, field
+
+
+@dataclass
+class FakeConfig:
+    # 最初のチャンクが返るまでの時間 (秒)
+    latency: float = 0.2
+    # ストリーミング時のチャンクの間隔 (秒) と1チャンクの文字数
+    chunk_delay: float = 0.005
+    chunk_chars: int = 80
+    # 生成する解説の長さ (文字数)
+    response_chars: int = 4000
+    # 回答の最後にクイズと解答キーを付けるか
+    include_quiz: bool = True
+    quiz_answer: str = "3"
+    calls: list = field(default_factory=list)
+
+
+config = FakeConfig()
+_lock = threading.Lock()
+
+
+def _count_tokens(text):
+    # 実際のトークナイザーの代わりに、英数字は4文字で1トークン、全角文字は1文字で1トークンとして概算する
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return max(1, ascii_chars // 4 + len(text) - ascii_chars)
+
+
+class _UsageMetadata:
+    def __init__(self, prompt, text):
+        self.prompt_token_count = _count_tokens(prompt)
+        self.candidates_token_count = _count_tokens(text)
+        self.total_token_count = self.prompt_token_count + self.candidates_token_count
+        self.cached_content_token_count = 0
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    def __init__(self, prompt, text, stream):
+        self._prompt = prompt
+        self._full_text = text
+        self._stream = stream
+        self.usage_metadata = None if stream else _UsageMetadata(prompt, text)
+
+    @property
+    def text(self):
+        return self._full_text
+
+    def __iter__(self):
+        if not self._stream:
+            yield _Chunk(self._full_text)
+            return
+        size = max(1, config.chunk_chars)
+        for start in range(0, len(self._full_text), size):
+            if start and config.chunk_delay:
+                time.sleep(config.chunk_delay)
+            yield _Chunk(self._full_text[start:start + size])
+        self.usage_metadata = _UsageMetadata(self._prompt, self._full_text)
+
+
+def make_chat_text(prompt):
+    paragraph = "先ほどのコードの range(3) を range(5) に変えると、5回繰り返します。\n"
+    return (paragraph * (config.response_chars // 4 // len(paragraph) + 1))[:config.response_chars // 4]
+
+
+def make_summary_text():
+    # 実際のモデルと同じく、長さの指示よりやや長めの要約を返す (出力の上限で切られる)
+    item = (
+        "- 関数 add(a, b) は2つの引数を足した値を返す。引数の型は確認していないため、"
+        "文字列と数値を渡すと TypeError になる可能性がある\n"
+        "  ```python\n  def add(a, b):\n      return a + b\n  ```\n"
+    )
+    return "## ファイルの役割\n同じ形の関数定義が繰り返し並んだモジュール。\n## 主な関数\n" + item * 12
+
+
+def _limit_output(text, max_output_tokens):
+    # generation_config の max_output_tokens を超えた分は、実際の API と同じく途中で打ち切る
+    if not max_output_tokens or _count_tokens(text) <= max_output_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if _count_tokens(text[:middle]) <= max_output_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+def make_response_text(prompt):
+    if "採点者" in prompt:
+        return "- **採点結果:** 正解です！\n- **解説:** ループの回数を正しく数えられています。"
+    if "要約してください" in prompt:
+        return make_summary_text()
+    paragraph = "変数に値を代入し、for 文で繰り返し処理を行います。\n```python\nfor i in range(3):\n    print(i)\n```\n\n"
+    body = (paragraph * (config.response_chars // len(paragraph) + 1))[:config.response_chars]
+    if config.include_quiz:
+        body += (
+            "\n\nQ: 上のコードで print は何回実行されますか？\n"
+            f'<!--ANSWER_KEY {{"answer": "{config.quiz_answer}", "accepted": ["{config.quiz_answer}回"], '
+            '"concept": "range(3) は 0, 1, 2 の3回繰り返す"} -->\n'
+        )
+    return body
+
+
+class ChatSession:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False, **kwargs):
+        # 実際の API と同じく、履歴と新しい発言をまとめて1回のリクエストとして送る
+        parts = [part for message in self.history for part in message["parts"]]
+        prompt = "\n".join(parts + [content])
+        response = self.model.generate_content(prompt, stream=stream, chat=True)
+        self.history += [{"role": "user", "parts": [content]}, {"role": "model", "parts": [response.text]}]
+        return response
+
+
+class GenerativeModel:
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def start_chat(self, history=None, **kwargs):
+        return ChatSession(self, history)
+
+    def generate_content(self, contents, stream=False, chat=False, **kwargs):
+        prompt = contents if isinstance(contents, str) else str(contents)
+        with _lock:
+            config.calls.append({"prompt_chars": len(prompt), "stream": stream, "chat": chat})
+        if config.latency:
+            time.sleep(config.latency)
+        text = make_chat_text(prompt) if chat else make_response_text(prompt)
+        generation_config = kwargs.get("generation_config") or {}
+        text = _limit_output(text, generation_config.get("max_output_tokens"))
+        return FakeResponse(prompt, text, stream)
+
+
+def configure(**kwargs):
+    pass
+
+
+def install(**overrides):
+    """偽の google.generativeai を sys.modules に登録し、設定を上書きする。"""
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    module = types.ModuleType("google.generativeai")
+    module.GenerativeModel = GenerativeModel
+    module.configure = configure
+    google = sys.modules.get("google")
+    if google is None:
+        google = types.ModuleType("google")
+        google.__path__ = []
+        sys.modules["google"] = google
+    google.generativeai = module
+    sys.modules["google.generativeai"] = module
+    return config
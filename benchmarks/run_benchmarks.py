@@ -0,0 +1,431 @@
+"""偽の Gemini (fake_gemini) を使い、ネットワークなしでアプリ全体の処理時間を測定する。
+
+Streamlit の AppTest でアプリを実際に実行し、次の場面ごとに1回の再実行にかかる時間を測る。
+
+- submit_no_file:      ファイルなしで「実行する」を押す
+- upload_utf8_500k:    50万文字の UTF-8 ファイルを付けて送信する
+- upload_shift_jis:    Shift-JIS のファイルを付けて送信する
+- upload_ipynb_large:  コードセルが約50万文字の .ipynb を付けて送信する
+- upload_zip_20_files: 20ファイル入りの .zip を付けて送信する (大きいファイルの要約を含む)
+- quiz_grading_local:  解答キーと一致する答えをその場で採点する
+- quiz_grading_api:    解答キーと一致しない答えを Gemini (偽物) で採点する
+- followup_12_turns:   最初の回答に続けて12回質問し、1回あたりの時間と送信する文字数の増え方を見る
+- parse_long_response: 非常に長い回答から解説・クイズ・解答キーを取り出す (一括とストリーミング)
+
+AppTest は file_uploader を操作できないため、アップロードの場面では st.file_uploader を
+差し替え、メモリ上のファイルのリストを st.session_state に置いてからアプリを実行する。
+
+結果は JSON で出力でき、thresholds.json の上限を超えた場面があれば終了コード 1 で終わる。
+
+使い方 (リポジトリのルートで実行):
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --repeat 10 --output results.json
+    python benchmarks/run_benchmarks.py --only submit_no_file --latency 0.2
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+DEFAULT_THRESHOLDS_PATH = os.path.join(BENCHMARK_DIR, "thresholds.json")
+
+TARGET_CHARS = 500_000
+CORRECT_ANSWER = "３回"
+OPEN_ANSWER = "ループが3回まわるので3回"
+# app.py の STREAM_RENDER_INTERVAL と同じ値
+RENDER_INTERVAL = 0.1
+
+
+def prepare_environment(work_dir):
+    # アプリや各モジュールは import 時に環境変数を読むため、import より前に設定する
+    os.environ["GOOGLE_API_KEY"] = "dummy-key-for-benchmark"
+    os.environ["GEMINI_REQUESTS_PER_MINUTE"] = "1000000"
+    os.environ["GEMINI_WARMUP"] = ""
+    os.environ["APP_METRICS"] = ""
+    # プロンプト固定部分のキャッシュは、ローカルの代わりで効果を見積もる
+    os.environ["GEMINI_PREFIX_CACHE"] = "local"
+    os.environ["RESPONSE_CACHE_PATH"] = os.path.join(work_dir, "response_cache.sqlite3")
+    os.environ["SESSION_STORE_PATH"] = os.path.join(work_dir, "session_store.sqlite3")
+    sys.path.insert(0, REPO_ROOT)
+    sys.path.insert(0, BENCHMARK_DIR)
+
+
+class FakeUpload:
+    """st.file_uploader が返す UploadedFile のうち、アプリが使う部分だけを持つ。"""
+
+    def __init__(self, name, data):
+        self.name = name
+        self.size = len(data)
+        self._data = data
+
+    def getbuffer(self):
+        return memoryview(self._data)
+
+
+class UploadPatch:
+    """st.file_uploader を差し替え、next_files に設定したファイルがアップロードされた状態にする。"""
+
+    def __init__(self, st):
+        self._st = st
+        self._original = st.file_uploader
+        self.next_files = None
+        st.file_uploader = self._file_uploader
+
+    def _file_uploader(self, label, *args, key=None, **kwargs):
+        if self.next_files is None or key is None:
+            return self._original(label, *args, key=key, **kwargs)
+        self._st.session_state[key] = self.next_files
+        return self.next_files
+
+    def restore(self):
+        self._st.file_uploader = self._original
+
+
+def make_text(chars):
+    line = "def add(a, b):  # 足し算をする関数\n    return a + b\n"
+    return (line * (chars // len(line) + 1))[:chars]
+
+
+def make_notebook(code_chars):
+    cells = []
+    total = 0
+    while total < code_chars:
+        source = [f"x = {len(cells)}\n", "print(x)  # 確認\n"] * 20
+        total += sum(len(s) for s in source)
+        cells.append({
+            "cell_type": "code",
+            "source": source,
+            "outputs": [{"output_type": "display_data", "data": {"image/png": "iVBORw0KGgo" * 200}}],
+            "metadata": {},
+        })
+        cells.append({"cell_type": "markdown", "source": ["## メモ\n"] * 10, "metadata": {}})
+    notebook = {"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 5}
+    return json.dumps(notebook, ensure_ascii=False)
+
+
+def make_zip(file_count, chars_per_file):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for index in range(file_count):
+            # ファイルごとに内容を変え、要約が別々に依頼されるようにする
+            text = f"# module {index}\n" + make_text(chars_per_file)
+            archive.writestr(f"project/module_{index:02d}.py", text)
+        archive.writestr("project/image.png", b"\x89PNG")
+    return buffer.getvalue()
+
+
+def make_uploads():
+    text = make_text(TARGET_CHARS)
+    return {
+        "upload_utf8_500k": [FakeUpload("sample.py", text.encode("utf-8"))],
+        "upload_shift_jis": [FakeUpload("sample.txt", make_text(TARGET_CHARS // 2).encode("shift-jis"))],
+        # 抽出後のコードが文字数制限に収まるよう、少し小さめにする
+        "upload_ipynb_large": [FakeUpload("sample.ipynb", make_notebook(TARGET_CHARS - 5_000).encode("utf-8"))],
+        "upload_zip_20_files": [FakeUpload("project.zip", make_zip(20, 20_000))],
+    }
+
+
+def click(at, label):
+    for button in at.button:
+        if button.label == label:
+            button.click()
+            return at.run()
+    raise RuntimeError(f"ボタン '{label}' が見つかりません")
+
+
+def check_no_exception(at, scenario):
+    if at.exception:
+        raise RuntimeError(f"{scenario}: アプリで例外が発生しました: {at.exception[0].value}")
+    if at.error:
+        raise RuntimeError(f"{scenario}: エラーが表示されました: {at.error[0].value}")
+
+
+def time_runs(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples, **extra):
+    return dict(
+        median_seconds=statistics.median(samples),
+        min_seconds=min(samples),
+        max_seconds=max(samples),
+        repeat=len(samples),
+        **extra,
+    )
+
+
+def new_app():
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(REPO_ROOT, "app.py"), default_timeout=60)
+    at.run()
+    at.text_area(key="problem_details").input("for 文で同じ処理を繰り返す方法を教えてください")
+    # 毎回 Gemini (偽物) まで到達させるため、保存済みの回答は使わない
+    at.checkbox(key="bypass_cache").check()
+    # プロンプトの組み立て時間やキャッシュ済みトークンの割合を last_metrics から読むため
+    at.checkbox(key="show_diagnostics").check()
+    return at
+
+
+def bench_submit(scenario, repeat, upload_patch, uploads=None):
+    import fake_gemini
+    from file_decoding import clear_memo
+    from response_cache import ResponseCache
+
+    at = new_app()
+    upload_patch.next_files = uploads
+    # ファイルの要約は内容ごとに保存されるため、毎回消して要約 (map) から測定する
+    response_cache = ResponseCache(os.environ["RESPONSE_CACHE_PATH"])
+
+    def submit():
+        clear_memo()
+        response_cache.clear()
+        click(at, "実行する")
+
+    try:
+        submit()  # 初回の import やキャッシュ作成を除くため、1回目は測定しない
+        check_no_exception(at, scenario)
+        calls_before = len(fake_gemini.config.calls)
+        samples = time_runs(submit, repeat)
+        check_no_exception(at, scenario)
+    finally:
+        upload_patch.next_files = None
+    if at.session_state["response_handle"] is None:
+        raise RuntimeError(f"{scenario}: 回答が保存されていません")
+    last_metrics = at.session_state["last_metrics"]
+    values = last_metrics["values"]
+    extra = {}
+    if "files_summarized" in values:
+        # 要約を依頼したのに最終的なプロンプトで使われなかったファイルの数 (呼び出しの無駄)
+        extra["summaries_discarded"] = values["files_summarized"] - values.get("files_summary_used", 0)
+    return summarize(
+        samples,
+        api_calls_per_submit=(len(fake_gemini.config.calls) - calls_before) / repeat,
+        prompt_seconds=last_metrics["stages"].get("prompt"),
+        cached_token_ratio=values.get("cached_token_ratio"),
+        **extra,
+    )
+
+
+def bench_grading(scenario, repeat, answer, expect_api):
+    import fake_gemini
+
+    at = new_app()
+    click(at, "実行する")
+    if not at.session_state["quiz_question"]:
+        raise RuntimeError(f"{scenario}: クイズが取り出せていません")
+    at.text_input(key="quiz_answer_input").input(answer)
+    calls_before = len(fake_gemini.config.calls)
+
+    def grade():
+        click(at, "採点する")
+
+    grade()
+    samples = time_runs(grade, repeat)
+    check_no_exception(at, scenario)
+    api_calls = len(fake_gemini.config.calls) - calls_before
+    if expect_api != (api_calls > 0):
+        raise RuntimeError(f"{scenario}: 採点での API 呼び出し回数が想定と異なります ({api_calls}回)")
+    if not at.session_state["quiz_evaluated"]:
+        raise RuntimeError(f"{scenario}: 採点結果が表示されていません")
+    return summarize(samples, api_calls=api_calls)
+
+
+def bench_followup(scenario, turns=12):
+    import fake_gemini
+
+    at = new_app()
+    click(at, "実行する")
+    samples = []
+    prompt_chars = []
+    for turn in range(turns):
+        at.text_area(key="followup_input").input(f"{turn + 1}回目の質問: range の引数を変えるとどうなりますか？")
+        calls_before = len(fake_gemini.config.calls)
+        start = time.perf_counter()
+        click(at, "質問する")
+        samples.append(time.perf_counter() - start)
+        check_no_exception(at, scenario)
+        chat_calls = [call for call in fake_gemini.config.calls[calls_before:] if call["chat"]]
+        if len(chat_calls) != 1:
+            raise RuntimeError(f"{scenario}: {turn + 1}回目の質問が送信されていません")
+        prompt_chars.append(chat_calls[0]["prompt_chars"])
+    half = turns // 2
+    return summarize(
+        samples,
+        prompt_chars=prompt_chars,
+        # 会話の後半で送る文字数が前半と比べてどれだけ増えたか (履歴を要約していれば 1 前後で止まる)
+        late_prompt_ratio=max(prompt_chars[half:]) / max(prompt_chars[:half]),
+        summarized_turns=at.session_state["followup_chat"].summarized_turns,
+    )
+
+
+def bench_parse_long_response(repeat):
+    import fake_gemini
+    from quiz import StreamingQuizExtractor, parse_response
+
+    original_chars = fake_gemini.config.response_chars
+    fake_gemini.config.response_chars = 2_000_000
+    try:
+        text = fake_gemini.make_response_text("")
+    finally:
+        fake_gemini.config.response_chars = original_chars
+    chunk_size = max(1, fake_gemini.config.chunk_chars)
+    chunks = [text[start:start + chunk_size] for start in range(0, len(text), chunk_size)]
+
+    def parse_all():
+        _, _, quiz, answer_key = parse_response(text)
+        assert quiz and answer_key, "クイズまたは解答キーが取り出せていません"
+
+    def parse_streaming():
+        # アプリと同じく、途中表示の組み立ては RENDER_INTERVAL ごとに1回だけ行う
+        extractor = StreamingQuizExtractor()
+        last_render = 0.0
+        for chunk in chunks:
+            if extractor.feed(chunk) and time.perf_counter() - last_render >= RENDER_INTERVAL:
+                extractor.visible_text()
+                last_render = time.perf_counter()
+        _, _, quiz, answer_key = extractor.finish()
+        assert quiz and answer_key, "クイズまたは解答キーが取り出せていません"
+
+    whole = time_runs(parse_all, repeat)
+    streaming = time_runs(parse_streaming, repeat)
+    return summarize(
+        whole,
+        response_chars=len(text),
+        streaming_median_seconds=statistics.median(streaming),
+        streaming_chunks=len(chunks),
+    )
+
+
+SCENARIOS = (
+    "submit_no_file",
+    "upload_utf8_500k",
+    "upload_shift_jis",
+    "upload_ipynb_large",
+    "upload_zip_20_files",
+    "quiz_grading_local",
+    "quiz_grading_api",
+    "followup_12_turns",
+    "parse_long_response",
+)
+
+
+def run_scenarios(names, repeat):
+    import streamlit as st
+
+    uploads = make_uploads()
+    upload_patch = UploadPatch(st)
+    results = {}
+    try:
+        for name in names:
+            if name == "submit_no_file":
+                results[name] = bench_submit(name, repeat, upload_patch)
+            elif name in uploads:
+                results[name] = bench_submit(name, repeat, upload_patch, uploads[name])
+            elif name == "quiz_grading_local":
+                results[name] = bench_grading(name, repeat, CORRECT_ANSWER, expect_api=False)
+            elif name == "quiz_grading_api":
+                results[name] = bench_grading(name, repeat, OPEN_ANSWER, expect_api=True)
+            elif name == "followup_12_turns":
+                results[name] = bench_followup(name)
+            elif name == "parse_long_response":
+                results[name] = bench_parse_long_response(repeat)
+            print(f"{name:22s} median {results[name]['median_seconds'] * 1000:9.2f} ms", file=sys.stderr)
+    finally:
+        upload_patch.restore()
+    return results
+
+
+def check_thresholds(results, thresholds):
+    """上限を超えた項目を (場面, 項目, 測定値, 上限) のリストで返す。"""
+    regressions = []
+    for name, limits in thresholds.items():
+        if name not in results:
+            continue
+        for metric, limit in limits.items():
+            value = results[name].get(metric)
+            if value is not None and value > limit:
+                regressions.append((name, metric, value, limit))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="各場面の測定回数")
+    parser.add_argument("--only", action="append", choices=SCENARIOS, help="指定した場面だけ実行する (複数指定可)")
+    parser.add_argument("--output", help="結果を JSON で書き出すファイル")
+    parser.add_argument("--thresholds", default=DEFAULT_THRESHOLDS_PATH, help="上限を記述した JSON ファイル")
+    parser.add_argument("--no-check", action="store_true", help="上限の確認を行わない")
+    # 偽の Gemini の設定 (既定では待ち時間なしで、アプリ側の処理時間だけを測る)
+    parser.add_argument("--latency", type=float, default=0.0, help="最初のチャンクまでの時間 (秒)")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="ストリーミングのチャンク間隔 (秒)")
+    parser.add_argument("--chunk-chars", type=int, default=80, help="1チャンクの文字数")
+    parser.add_argument("--response-chars", type=int, default=4000, help="生成する解説の文字数")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    work_dir = tempfile.mkdtemp(prefix="app-bench-")
+    prepare_environment(work_dir)
+
+    import fake_gemini
+
+    fake_config = fake_gemini.install(
+        latency=args.latency,
+        chunk_delay=args.chunk_delay,
+        chunk_chars=args.chunk_chars,
+        response_chars=args.response_chars,
+    )
+    results = run_scenarios(args.only or SCENARIOS, args.repeat)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+        },
+        "fake_gemini": {
+            "latency": fake_config.latency,
+            "chunk_delay": fake_config.chunk_delay,
+            "chunk_chars": fake_config.chunk_chars,
+            "response_chars": fake_config.response_chars,
+            "calls": len(fake_config.calls),
+        },
+        "results": results,
+    }
+
+    regressions = []
+    if not args.no_check and os.path.exists(args.thresholds):
+        with open(args.thresholds, encoding="utf-8") as f:
+            regressions = check_thresholds(results, json.load(f))
+    report["regressions"] = [
+        {"scenario": name, "metric": metric, "value": value, "limit": limit}
+        for name, metric, value, limit in regressions
+    ]
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    for name, metric, value, limit in regressions:
+        print(f"上限超過: {name} の {metric} = {value:.4f} (上限 {limit})", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
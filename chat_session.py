@@ -0,0 +1,145 @@
+"""最初の回答に続けて質問する (フォローアップ) ための会話履歴の管理。
+
+Gemini のチャット (model.start_chat) に渡す履歴を、次の順で組み立てる。
+    1. 最初の依頼 (アップロードしたファイルを含む) と最初の回答 … 毎回そのまま共有する
+    2. 古いやり取りの要約 … 履歴が上限を超えたら、古い順に要約へまとめる
+    3. 直近のやり取り … そのまま残す
+API 自体は履歴を保持しないため履歴は毎回送られるが、2 と 3 の合計が上限内に収まるので、
+会話が長くなっても1回あたりの入力トークン数はほぼ一定になる。
+
+要約はスケジューラに予約してバックグラウンドで進め、次の質問のときに結果を取り込む。
+Streamlit や Gemini には依存しないので、テキストの読み出しや要約の依頼方法は呼び出し側から渡す。
+"""
+import os
+from dataclasses import dataclass
+
+from context_builder import estimate_tokens
+
+DEFAULT_HISTORY_TOKEN_BUDGET = int(os.getenv("FOLLOWUP_HISTORY_TOKEN_BUDGET", "4000"))
+# 要約せずにそのまま残す直近のやり取りの数
+DEFAULT_KEEP_RECENT_TURNS = int(os.getenv("FOLLOWUP_KEEP_RECENT_TURNS", "2"))
+SUMMARY_MAX_OUTPUT_TOKENS = 512
+
+_summary_acknowledgement = "これまでのやり取りの要約を確認しました。続けて質問にお答えします。"
+
+
+@dataclass
+class ChatTurn:
+    question: str
+    answer: str
+    tokens: int
+
+
+class FollowUpChat:
+    """1つの回答に対するフォローアップの会話。st.session_state に置いて使う。
+
+    最初の依頼と回答の本体は SessionStore に保存したまま、ここには blob_id だけを持つ。
+    """
+
+    def __init__(self, prompt_blob_id, answer_blob_id, token_budget=DEFAULT_HISTORY_TOKEN_BUDGET,
+                 keep_recent_turns=DEFAULT_KEEP_RECENT_TURNS):
+        self.prompt_blob_id = prompt_blob_id
+        self.answer_blob_id = answer_blob_id
+        self.token_budget = token_budget
+        self.keep_recent_turns = keep_recent_turns
+        self.turns = []
+        self.summary = ""
+        self.summarized_turns = 0
+        # 要約中のリクエストと、それがまとめるやり取りの数
+        self._pending = None
+        self._pending_count = 0
+
+    @property
+    def history_tokens(self):
+        """共有する最初の依頼と回答を除いた、履歴部分のトークン数の見積もり。"""
+        return estimate_tokens(self.summary) + sum(turn.tokens for turn in self.turns)
+
+    def build_history(self, load_text):
+        """start_chat に渡す履歴を返す。load_text(blob_id) は保存したテキストを返す関数。
+
+        最初の依頼か回答が読み出せない (解放済みなど) 場合は None を返す。
+        """
+        prompt_text = load_text(self.prompt_blob_id)
+        answer_text = load_text(self.answer_blob_id)
+        if prompt_text is None or answer_text is None:
+            return None
+        history = [
+            {"role": "user", "parts": [prompt_text]},
+            {"role": "model", "parts": [answer_text]},
+        ]
+        if self.summary:
+            history.append({"role": "user", "parts": [f"# これまでのやり取りの要約\n{self.summary}"]})
+            history.append({"role": "model", "parts": [_summary_acknowledgement]})
+        for turn in self.turns:
+            history.append({"role": "user", "parts": [turn.question]})
+            history.append({"role": "model", "parts": [turn.answer]})
+        return history
+
+    def add_turn(self, question, answer):
+        self.turns.append(ChatTurn(question, answer, estimate_tokens(question) + estimate_tokens(answer)))
+
+    def needs_compaction(self):
+        return (
+            self._pending is None
+            and len(self.turns) > self.keep_recent_turns
+            and self.history_tokens > self.token_budget
+        )
+
+    def build_compaction_prompt(self, count):
+        parts = [
+            "以下はプログラミング学習者とアシスタントの会話の一部です。",
+            "このあとの質問に答えるための資料として、要点を日本語の箇条書きで簡潔に要約してください。",
+            "- 学習者が知りたかったこと・つまずいていた点",
+            "- アシスタントが示した解決策やコードの要点 (重要な名前や値はそのまま残す)",
+        ]
+        if self.summary:
+            parts += ["\n# これまでの要約", self.summary]
+        parts.append("\n# 新しく要約に加えるやり取り")
+        for turn in self.turns[:count]:
+            parts += [f"質問: {turn.question}", f"回答: {turn.answer}"]
+        return "\n".join(parts)
+
+    def start_compaction(self, submit):
+        """直近以外のやり取りの要約を予約する。submit(prompt) は result() で要約を返すオブジェクトを返す。"""
+        if not self.needs_compaction():
+            return False
+        count = len(self.turns) - self.keep_recent_turns
+        self._pending = submit(self.build_compaction_prompt(count))
+        self._pending_count = count
+        return True
+
+    def apply_compaction(self, wait=False):
+        """要約が終わっていれば履歴に取り込む。wait=True なら終わるまで待つ。
+
+        要約に失敗した場合は、古いやり取りを機械的に短くして要約の代わりにする。
+        """
+        if self._pending is None:
+            return False
+        if not wait and not self._pending.done():
+            return False
+        request, count = self._pending, self._pending_count
+        self._pending = None
+        self._pending_count = 0
+        try:
+            summary = request.result()
+        except Exception:
+            summary = None
+        if not summary:
+            summary = "\n".join([self.summary] + [_fallback_summary(turn) for turn in self.turns[:count]]).strip()
+        self.summary = summary
+        self.summarized_turns += count
+        del self.turns[:count]
+        return True
+
+    def prepare_turn(self):
+        # 次の質問を送る前に、終わっている要約を取り込む。
+        # 上限を大きく超えていれば、履歴が増え続けないよう要約を待つ
+        over_limit = self.history_tokens > self.token_budget * 2
+        return self.apply_compaction(wait=over_limit)
+
+
+def _fallback_summary(turn, max_chars=200):
+    answer = turn.answer.strip().replace("\n", " ")
+    if len(answer) > max_chars:
+        answer = answer[:max_chars] + "..."
+    return f"- 質問: {turn.question.strip()} / 回答の要点: {answer}"
@@ -0,0 +1,548 @@
+"""アップロードされたファイルを、プロンプトに入れる前にトークン上限内へ縮める処理。
+
+ファイルの種類ごとに、質問に関係しそうな部分を優先して残す。
+    .py    : AST で関数・クラス単位に分け、質問と関係の深いものを残す
+    .log   : 繰り返し行をまとめ、トレースバックと末尾を残す
+    .csv   : 列の構成 (スキーマ) と先頭・末尾のサンプル行を残す
+    .json  : 構造 (スキーマ) と配列の先頭要素のサンプルを残す
+    .ipynb : コードセルを質問との関連度で並べ、上位のセルを残す
+それ以外のファイルは先頭と末尾を残す。上限内に収まるファイルはそのまま使う。
+"""
+import ast
+import bisect
+import csv
+import io
+import json
+import math
+import os
+import re
+from dataclasses import dataclass
+
+DEFAULT_TOKEN_BUDGET = int(os.getenv("FILE_CONTEXT_TOKEN_BUDGET", "8000"))
+
+_identifier_pattern = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+_line_number_pattern = re.compile(r"(?:line\s+(\d+)|(\d+)\s*行目)", re.IGNORECASE)
+_error_pattern = re.compile(r"(error|exception|traceback|warn|fail|エラー|例外)", re.IGNORECASE)
+_digits_pattern = re.compile(r"\d+")
+_stop_words = {"the", "and", "for", "with", "this", "that", "from", "import", "def", "class", "self", "return"}
+
+
+@dataclass
+class FileContext:
+    text: str
+    strategy: str
+    original_chars: int
+    original_tokens: int
+    kept_tokens: int
+
+    @property
+    def kept_ratio(self):
+        if not self.original_tokens:
+            return 1.0
+        return min(1.0, self.kept_tokens / self.original_tokens)
+
+    @property
+    def reduced(self):
+        return self.strategy != "full"
+
+
+def estimate_tokens(text):
+    # 英数字はおよそ4文字で1トークン、日本語などの全角文字は1文字で約1トークンとして見積もる
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def _query_terms(query):
+    return {term.lower() for term in _identifier_pattern.findall(query or "")} - _stop_words
+
+
+def _query_line_numbers(query):
+    return {int(a or b) for a, b in _line_number_pattern.findall(query or "")}
+
+
+def _relevance(text, terms):
+    lowered = text.lower()
+    return sum(lowered.count(term) for term in terms)
+
+
+def _omitted(count):
+    return f"... ({count}行省略) ..."
+
+
+def _omitted_cost(count):
+    return estimate_tokens(_omitted(count)) + 1 if count else 0
+
+
+# これより少ない枠しか残っていなければ、入り切らない行やセルを切り詰めてまで入れない
+_min_truncated_tokens = 16
+
+
+def _head_tail(text, keep_chars):
+    tail_chars = keep_chars // 2
+    head = text[:keep_chars - tail_chars]
+    tail = text[len(text) - tail_chars:] if tail_chars else ""
+    return f"{head} ... ({len(text) - keep_chars}文字省略) ... {tail}"
+
+
+def _truncate_text(text, token_budget):
+    """上限を超える1行 (1セル) を、先頭と末尾を残して上限内に切り詰める。"""
+    if estimate_tokens(text) <= token_budget:
+        return text
+    # 残す文字数を二分探索する (全角と半角でトークン数の見積もりが異なるため)
+    low, high = 0, len(text) - 1
+    best = None
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = _head_tail(text, middle)
+        if estimate_tokens(candidate) <= token_budget:
+            best = candidate
+            low = middle + 1
+        else:
+            high = middle - 1
+    return best
+
+
+def _select_lines(lines, priorities, token_budget):
+    """優先度の小さい行から順に上限まで選び、元の順序で省略記号付きのテキストにする。
+
+    priorities は行ごとの優先度 (小さいほど優先、None は選ばない)。
+    同じ優先度の中では後ろの行を優先する。
+    省略記号のトークン数も選びながら数えるので、結果は上限を超えない。
+    残りの枠に入り切らない行は、読み飛ばさずに先頭と末尾を残して切り詰める。
+    """
+    order = sorted(
+        (i for i, priority in enumerate(priorities) if priority is not None),
+        key=lambda i: (priorities[i], -i),
+    )
+    # 選んだ行の位置 (両端に番兵を置く)。行を1つ選ぶと、その行を含む省略区間が前後2つに分かれる
+    kept = [-1, len(lines)]
+    truncated = {}
+    used = _omitted_cost(len(lines))
+    for i in order:
+        position = bisect.bisect(kept, i)
+        previous, following = kept[position - 1], kept[position]
+        line_cost = estimate_tokens(lines[i])
+        marker_cost = (
+            1 + _omitted_cost(i - previous - 1) + _omitted_cost(following - i - 1)
+            - _omitted_cost(following - previous - 1)
+        )
+        if used + line_cost + marker_cost > token_budget:
+            available = token_budget - used - marker_cost
+            if available < _min_truncated_tokens:
+                continue
+            truncated[i] = _truncate_text(lines[i], available)
+            line_cost = estimate_tokens(truncated[i])
+        kept.insert(position, i)
+        used += line_cost + marker_cost
+    return _render_selected(lines, set(kept[1:-1]), truncated)
+
+
+def _render_selected(lines, kept, truncated=None):
+    truncated = truncated or {}
+    output = []
+    skipped = 0
+    for i, line in enumerate(lines):
+        if i in kept:
+            if skipped:
+                output.append(_omitted(skipped))
+                skipped = 0
+            output.append(truncated.get(i, line))
+        else:
+            skipped += 1
+    if skipped:
+        output.append(_omitted(skipped))
+    return "\n".join(output)
+
+
+def _reduce_head_tail(content, query, token_budget):
+    lines = content.split("\n")
+    line_numbers = _query_line_numbers(query)
+    head_count = max(1, len(lines) * 2 // 5)
+    priorities = []
+    for i, line in enumerate(lines):
+        if i + 1 in line_numbers:
+            priorities.append(0)
+        elif i >= len(lines) - head_count:
+            priorities.append(1)
+        else:
+            # 先頭側は前の行ほど優先する
+            priorities.append(2 + i / len(lines))
+    return _select_lines(lines, priorities, token_budget)
+
+
+def _reduce_around_line(content, line_number, token_budget):
+    # 構文エラーなど位置がわかっている場合は、その周辺を最優先で残す
+    lines = content.split("\n")
+    priorities = [abs(i + 1 - line_number) for i in range(len(lines))]
+    return _select_lines(lines, priorities, token_budget)
+
+
+def _python_units(tree, lines):
+    # トップレベルの関数・クラス (大きなクラスはメソッド単位) と、それ以外の文のまとまりに分ける
+    units = []
+    loose_start = None
+
+    def node_range(node):
+        start = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+        return start, node.end_lineno
+
+    def flush_loose(end):
+        nonlocal loose_start
+        if loose_start is not None:
+            units.append({"name": "", "start": loose_start, "end": end, "kind": "module"})
+            loose_start = None
+
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            flush_loose(node_range(node)[0] - 1)
+            start, end = node_range(node)
+            methods = [n for n in node.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))] \
+                if isinstance(node, ast.ClassDef) else []
+            if methods:
+                header_end = node_range(methods[0])[0] - 1
+                units.append({"name": node.name, "start": start, "end": header_end, "kind": "class"})
+                for method in methods:
+                    m_start, m_end = node_range(method)
+                    units.append({"name": f"{node.name}.{method.name}", "start": m_start,
+                                  "end": m_end, "kind": "method", "signature": m_start})
+                if methods[-1].end_lineno < end:
+                    units.append({"name": node.name, "start": methods[-1].end_lineno + 1,
+                                  "end": end, "kind": "class"})
+            else:
+                kind = "class" if isinstance(node, ast.ClassDef) else "function"
+                units.append({"name": node.name, "start": start, "end": end, "kind": kind,
+                              "signature": node.lineno})
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            flush_loose(node.lineno - 1)
+            units.append({"name": "", "start": node.lineno, "end": node.end_lineno, "kind": "import"})
+        elif loose_start is None:
+            loose_start = node.lineno
+    flush_loose(len(lines))
+    return units
+
+
+def _reduce_python(content, query, token_budget):
+    lines = content.split("\n")
+    try:
+        tree = ast.parse(content)
+    except SyntaxError as e:
+        if e.lineno:
+            return _reduce_around_line(content, e.lineno, token_budget), "python-syntax-error"
+        return _reduce_head_tail(content, query, token_budget), "head-tail"
+    except (RecursionError, ValueError, MemoryError):
+        # 入れ子が深すぎる・NUL文字を含むなど、AST にできないファイル
+        return _reduce_head_tail(content, query, token_budget), "head-tail"
+
+    terms = _query_terms(query)
+    line_numbers = _query_line_numbers(query)
+    units = _python_units(tree, lines)
+    for unit in units:
+        unit_lines = lines[unit["start"] - 1:unit["end"]]
+        text = "\n".join(unit_lines)
+        unit["tokens"] = sum(estimate_tokens(line) + 1 for line in unit_lines)
+        score = _relevance(text, terms)
+        leaf_name = unit["name"].split(".")[-1].lower()
+        if leaf_name and leaf_name in terms:
+            score += 5
+        if any(unit["start"] <= n <= unit["end"] for n in line_numbers):
+            score += 100
+        if unit["kind"] == "import":
+            score += 50
+        unit["score"] = score
+
+    # 関連度の高い単位から上限まで採用する。入り切らない関数は定義行だけ残し、
+    # 関連語を含まない単位は定義行の分を確保したうえで、残りの枠に先頭から入れる。
+    # 単位の間には省略記号が入り得るので、単位ごとにその分も見込んでおく
+    marker_cost = _omitted_cost(len(lines))
+    accepted = []
+    used = 0
+    for index in sorted(range(len(units)), key=lambda i: (-units[i]["score"], units[i]["start"])):
+        if units[index]["score"] > 0 and used + units[index]["tokens"] + marker_cost <= token_budget:
+            accepted.append(index)
+            used += units[index]["tokens"] + marker_cost
+    kept = set(accepted)
+    reserved = sum(
+        estimate_tokens(lines[unit["signature"] - 1]) + 1 + marker_cost
+        for index, unit in enumerate(units) if index not in kept and "signature" in unit
+    )
+    for index, unit in enumerate(units):
+        if index in kept:
+            continue
+        signature_cost = estimate_tokens(lines[unit["signature"] - 1]) + 1 + marker_cost if "signature" in unit else 0
+        if used + reserved - signature_cost + unit["tokens"] + marker_cost <= token_budget:
+            accepted.append(index)
+            kept.add(index)
+            used += unit["tokens"] + marker_cost
+            reserved -= signature_cost
+
+    # 採用した単位は採用した順 (関連度の高い順) に、単位の中では先頭の行から選ぶ。
+    # 見込みより省略記号が増えて入り切らなくても、関連度の低い単位の末尾から削られる
+    priorities = [None] * len(lines)
+    for rank, index in enumerate(accepted):
+        unit = units[index]
+        for line_no in range(unit["start"], unit["end"] + 1):
+            priorities[line_no - 1] = (0, rank, line_no)
+    for index, unit in enumerate(units):
+        if index in kept:
+            continue
+        if "signature" in unit:
+            priorities[unit["signature"] - 1] = (1, 0, unit["signature"])
+        else:
+            # import 以外の文やクラスの見出しは、枠が余っていれば先頭から入れる
+            for line_no in range(unit["start"], unit["end"] + 1):
+                priorities[line_no - 1] = (2, 0, line_no)
+    return _select_lines(lines, priorities, token_budget), "python-ast"
+
+
+def _collapse_repeated(lines):
+    # 数字 (時刻やIDなど) だけが異なる連続行を1行にまとめる
+    collapsed = []
+    previous_key = None
+    repeat = 0
+    for line in lines:
+        key = _digits_pattern.sub("0", line.strip())
+        if key == previous_key:
+            repeat += 1
+            continue
+        if repeat:
+            collapsed.append(f"    (上の行と同様の行が{repeat}回繰り返し)")
+        collapsed.append(line)
+        previous_key = key
+        repeat = 0
+    if repeat:
+        collapsed.append(f"    (上の行と同様の行が{repeat}回繰り返し)")
+    return collapsed
+
+
+def _reduce_log(content, query, token_budget):
+    lines = _collapse_repeated(content.split("\n"))
+    terms = _query_terms(query)
+    priorities = [None] * len(lines)
+
+    # トレースバックはエラーメッセージの行 (インデントのない行) までをひとまとまりとして扱う
+    in_traceback = False
+    for i, line in enumerate(lines):
+        if line.startswith("Traceback (most recent call last)"):
+            in_traceback = True
+        if in_traceback:
+            priorities[i] = 0
+            if i > 0 and line and not line[0].isspace() and not line.startswith("Traceback"):
+                in_traceback = False
+        elif _error_pattern.search(line) or (terms and _relevance(line, terms)):
+            priorities[i] = 2
+
+    # 末尾の行は直近の状況を表すので、トレースバックの次に優先する
+    tail_start = max(0, len(lines) - 200)
+    for i in range(tail_start, len(lines)):
+        if priorities[i] is None or priorities[i] > 1:
+            priorities[i] = 1
+    for i, priority in enumerate(priorities):
+        if priority is None:
+            priorities[i] = 3
+    return _select_lines(lines, priorities, token_budget), "log-tail"
+
+
+def _guess_type(values):
+    kinds = set()
+    for value in values:
+        value = value.strip()
+        if not value:
+            continue
+        for kind, convert in (("int", int), ("float", float)):
+            try:
+                convert(value)
+                kinds.add(kind)
+                break
+            except ValueError:
+                pass
+        else:
+            kinds.add("str")
+    if not kinds:
+        return "empty"
+    if kinds == {"int"}:
+        return "int"
+    if kinds <= {"int", "float"}:
+        return "float"
+    return "str"
+
+
+def _shorten(text, max_chars=40):
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+
+def _reduce_csv(content, query, token_budget):
+    try:
+        rows = list(csv.reader(io.StringIO(content)))
+    except csv.Error:
+        return _reduce_head_tail(content, query, token_budget), "head-tail"
+    if not rows:
+        return content, "full"
+    header, body = rows[0], rows[1:]
+    sample = body[:200]
+
+    def render(row_list):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(row_list)
+        return buffer.getvalue().rstrip("\n")
+
+    summary = [f"# CSVの構成: {len(body)}行 x {len(header)}列"]
+    # 行を省略したときの記号の分は先に確保しておく
+    used = estimate_tokens(summary[0]) + 1 + _omitted_cost(len(body))
+    # 列の一覧は上限の半分までにし、入り切らない列は数だけ示す (型の判定も一覧に載せる列だけ行う)
+    column_budget = token_budget // 2 - used - estimate_tokens(f"# 列: ... (残り{len(header)}列省略)") - 1
+    columns = []
+    column_tokens = 0
+    for index, name in enumerate(header):
+        column_type = _guess_type(row[index] for row in sample if index < len(row))
+        column = f"{_shorten(name)} ({column_type})"
+        cost = estimate_tokens(column) + 1
+        if column_tokens + cost > column_budget:
+            break
+        columns.append(column)
+        column_tokens += cost
+    all_listed = len(columns) == len(header)
+    if not all_listed:
+        columns.append(f"... (残り{len(header) - len(columns)}列省略)")
+    summary.append("# 列: " + ", ".join(columns))
+    used += estimate_tokens(summary[1]) + 1
+    lines = []
+    if not all_listed or any(len(name) > 40 for name in header):
+        # 列名をすべてそのまま載せられなかった場合だけ、ヘッダー行を (長ければ切り詰めて) 残す
+        available = min(token_budget // 5, token_budget - used - 1)
+        if available >= _min_truncated_tokens:
+            lines.append(_truncate_text(render([header]), available))
+            used += estimate_tokens(lines[0]) + 1
+    # 先頭の行を中心に、末尾も少し残す
+    head_rows, tail_rows = [], []
+    for row in body[:50]:
+        cost = estimate_tokens(render([row])) + 1
+        if used + cost > token_budget * 0.8:
+            break
+        head_rows.append(row)
+        used += cost
+    for row in reversed(body[max(len(head_rows), len(body) - 5):]):
+        cost = estimate_tokens(render([row])) + 1
+        if used + cost > token_budget:
+            break
+        tail_rows.insert(0, row)
+        used += cost
+    if head_rows:
+        lines.append(render(head_rows))
+    omitted = len(body) - len(head_rows) - len(tail_rows)
+    if omitted:
+        lines.append(_omitted(omitted))
+    if tail_rows:
+        lines.append(render(tail_rows))
+    return "\n".join(summary + lines), "csv-schema-sample"
+
+
+def _json_schema(value, depth=0):
+    if depth >= 6:
+        return "..."
+    if isinstance(value, dict):
+        return {key: _json_schema(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, list):
+        if not value:
+            return "list[0]"
+        return [f"list[{len(value)}]", _json_schema(value[0], depth + 1)]
+    if value is None:
+        return "null"
+    return type(value).__name__
+
+
+def _json_sample(value, max_items=3, max_string=200, depth=0):
+    if depth >= 6 and isinstance(value, (dict, list)):
+        return "..."
+    if isinstance(value, dict):
+        return {key: _json_sample(item, max_items, max_string, depth + 1) for key, item in value.items()}
+    if isinstance(value, list):
+        sample = [_json_sample(item, max_items, max_string, depth + 1) for item in value[:max_items]]
+        if len(value) > max_items:
+            sample.append(f"... (残り{len(value) - max_items}件省略)")
+        return sample
+    if isinstance(value, str) and len(value) > max_string:
+        return value[:max_string] + "..."
+    return value
+
+
+def _reduce_json(content, query, token_budget):
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError as e:
+        # 壊れたJSONは、エラー位置の周辺を残すのが一番役に立つ
+        return _reduce_around_line(content, e.lineno, token_budget), "json-syntax-error"
+    except (RecursionError, ValueError):
+        # 入れ子が深すぎて解析できない (正しい) JSON など
+        return _reduce_head_tail(content, query, token_budget), "head-tail"
+    schema = json.dumps(_json_schema(data), ensure_ascii=False, indent=1)
+    sample = json.dumps(_json_sample(data), ensure_ascii=False, indent=1)
+    text = f"# JSONの構造\n{schema}\n\n# サンプル (配列は先頭の要素のみ)\n{sample}"
+    if estimate_tokens(text) > token_budget:
+        text = _reduce_head_tail(text, query, token_budget)
+    return text, "json-schema-sample"
+
+
+def _reduce_notebook(cells, query, token_budget):
+    terms = _query_terms(query)
+    scored = []
+    for index, cell in enumerate(cells):
+        score = _relevance(cell, terms) * 2 + len(_error_pattern.findall(cell))
+        # 先頭 (import や準備) と末尾 (作業中のセル) は関連語がなくても少し優先する
+        if index == 0 or index == len(cells) - 1:
+            score += 1
+        scored.append((score, index))
+
+    # セルの見出しと区切り、セルの前後に入り得る省略記号の分も数える。
+    # 入り切らないセルは、読み飛ばさずに先頭と末尾を残して切り詰める
+    marker_cost = estimate_tokens(f"# ... ({len(cells)}セル省略) ...") + 2
+    kept = {}
+    used = marker_cost
+    for score, index in sorted(scored, key=lambda item: (-item[0], -item[1])):
+        cell = cells[index]
+        overhead = estimate_tokens(f"# [セル {index + 1}]") + 3 + marker_cost
+        if used + estimate_tokens(cell) + overhead > token_budget:
+            available = token_budget - used - overhead
+            if available < _min_truncated_tokens:
+                continue
+            cell = _truncate_text(cell, available)
+        kept[index] = cell
+        used += estimate_tokens(cell) + overhead
+
+    output = []
+    skipped = 0
+    for index in range(len(cells)):
+        if index not in kept:
+            skipped += 1
+            continue
+        if skipped:
+            output.append(f"# ... ({skipped}セル省略) ...")
+            skipped = 0
+        output.append(f"# [セル {index + 1}]\n{kept[index]}")
+    if skipped:
+        output.append(f"# ... ({skipped}セル省略) ...")
+    return "\n\n".join(output), "ipynb-ranked-cells"
+
+
+def build_file_context(file_name, content, query="", token_budget=DEFAULT_TOKEN_BUDGET, cells=None):
+    """content をトークン上限内に縮めた FileContext を返す。
+
+    cells には .ipynb から取り出したコードセルのリストを渡す (あればセル単位で選ぶ)。
+    """
+    original_tokens = estimate_tokens(content)
+    if original_tokens <= token_budget:
+        return FileContext(content, "full", len(content), original_tokens, original_tokens)
+
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == ".ipynb" and cells:
+        text, strategy = _reduce_notebook(cells, query, token_budget)
+    elif extension == ".py":
+        text, strategy = _reduce_python(content, query, token_budget)
+    elif extension == ".log":
+        text, strategy = _reduce_log(content, query, token_budget)
+    elif extension == ".csv":
+        text, strategy = _reduce_csv(content, query, token_budget)
+    elif extension == ".json":
+        text, strategy = _reduce_json(content, query, token_budget)
+    else:
+        text, strategy = _reduce_head_tail(content, query, token_budget), "head-tail"
+    return FileContext(text, strategy, len(content), original_tokens, estimate_tokens(text))
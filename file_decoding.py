@@ -0,0 +1,238 @@
+"""アップロードされたファイルをテキストに変換する処理。
+
+バッファは memoryview で1回だけ読み、先頭の一部から文字コードの見当をつけてから
+全体をデコードする。.ipynb はJSON全体を組み立てずに走査し、コードセルの source だけを
+取り出す。結果はファイル内容のハッシュごとに保存し、同じファイルの再送信ではデコードしない。
+"""
+import codecs
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from json.decoder import scanstring
+
+# 文字コード判定に使う先頭部分の大きさ
+SAMPLE_BYTES = 64 * 1024
+# デコード結果を保持する件数と合計文字数の上限
+MEMO_MAX_ENTRIES = 32
+MEMO_MAX_CHARS = 20_000_000
+
+
+@dataclass
+class DecodedFile:
+    file_name: str
+    digest: str
+    size: int
+    text: str = None
+    encoding: str = None
+    # .ipynb のコードセル (解析できた場合のみ)
+    cells: list = None
+    # .ipynb の解析に失敗してテキストとして読み直した場合の理由
+    notebook_error: str = None
+    # テキストにできなかった場合の理由 (text は None になる)
+    error: str = None
+    from_memo: bool = field(default=False, compare=False)
+
+    @property
+    def is_notebook(self):
+        return self.file_name.endswith(".ipynb")
+
+
+class NotebookParseError(ValueError):
+    pass
+
+
+_whitespace = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+
+def _skip_ws(text, i):
+    return _whitespace.match(text, i).end()
+
+
+def _expect(text, i, char):
+    if i >= len(text) or text[i] != char:
+        raise NotebookParseError(f"位置 {i} に '{char}' がありません")
+    return i + 1
+
+
+def _skip_value(text, i):
+    """i から始まる値を読み飛ばし、その直後の位置を返す。
+
+    値は一時的に作られるが保持しないため、同時にメモリに載るのはセル1つ分の値までになる。
+    """
+    try:
+        return _decoder.raw_decode(text, i)[1]
+    except json.JSONDecodeError as e:
+        raise NotebookParseError(str(e)) from e
+
+
+def _iter_object(text, i):
+    """オブジェクトのキーを順に返すジェネレータ。値の位置は send で受け取った位置から読む。"""
+    i = _skip_ws(text, _expect(text, _skip_ws(text, i), "{"))
+    if i < len(text) and text[i] == "}":
+        return i + 1
+    while True:
+        i = _expect(text, i, '"')
+        key, i = scanstring(text, i)
+        i = _skip_ws(text, _expect(text, _skip_ws(text, i), ":"))
+        i = yield key, i
+        i = _skip_ws(text, i)
+        if i < len(text) and text[i] == ",":
+            i = _skip_ws(text, i + 1)
+            continue
+        return _expect(text, i, "}")
+
+
+def _walk_object(text, i, handle):
+    # handle(key, 値の開始位置) は値の直後の位置を返す
+    walker = _iter_object(text, i)
+    try:
+        key, value_start = next(walker)
+        while True:
+            key, value_start = walker.send(handle(key, value_start))
+    except StopIteration as stop:
+        return stop.value
+
+
+def _parse_cells(text, i, cells):
+    i = _skip_ws(text, _expect(text, i, "["))
+    if i < len(text) and text[i] == "]":
+        return i + 1
+    while True:
+        cell = {}
+
+        def handle(key, value_start):
+            if key in ("cell_type", "source"):
+                cell[key], end = _decoder.raw_decode(text, value_start)
+                return end
+            return _skip_value(text, value_start)
+
+        i = _skip_ws(text, _walk_object(text, i, handle))
+        if cell.get("cell_type") == "code":
+            cells.append("".join(cell.get("source", "")))
+        if i < len(text) and text[i] == ",":
+            i = _skip_ws(text, i + 1)
+            continue
+        return _expect(text, i, "]")
+
+
+def extract_notebook_code_cells(text):
+    """ノートブックのJSONを走査し、コードセルの source を文字列のリストで返す。
+
+    JSON全体のオブジェクトは作らず、セルを1つずつ読み、cell_type と source 以外
+    (outputs に含まれる画像など) は読み飛ばす。形式が不正な場合は NotebookParseError。
+    """
+    cells = []
+
+    def handle(key, value_start):
+        if key == "cells":
+            cells.clear()
+            return _parse_cells(text, value_start, cells)
+        return _skip_value(text, value_start)
+
+    try:
+        end = _walk_object(text, 0, handle)
+    except (json.JSONDecodeError, TypeError) as e:
+        raise NotebookParseError(str(e)) from e
+    if _skip_ws(text, end) != len(text):
+        raise NotebookParseError("JSONの後に余分なデータがあります")
+    return cells
+
+
+def _encoding_candidates(view):
+    # 先頭部分だけを UTF-8 として試し、だめなら Shift-JIS から先に試す
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(view[:SAMPLE_BYTES], final=False)
+        return ("utf-8", "shift-jis")
+    except UnicodeDecodeError:
+        return ("shift-jis", "utf-8")
+
+
+def decode_text(view):
+    """UTF-8 または Shift-JIS でデコードし、(テキスト, 文字コード) を返す。"""
+    last_error = None
+    for encoding in _encoding_candidates(view):
+        try:
+            return str(view, encoding), encoding
+        except UnicodeDecodeError as e:
+            last_error = e
+    raise last_error
+
+
+def _decode(file_name, view, digest):
+    decoded = DecodedFile(file_name=file_name, digest=digest, size=len(view))
+    if decoded.is_notebook:
+        try:
+            text = str(view, "utf-8")
+            decoded.cells = extract_notebook_code_cells(text)
+            decoded.text = "\n\n".join(decoded.cells)
+            decoded.encoding = "utf-8 (ipynb code cells)"
+            return decoded
+        except (NotebookParseError, UnicodeDecodeError) as e:
+            decoded.notebook_error = str(e)
+        try:
+            decoded.text, encoding = decode_text(view)
+            decoded.encoding = f"{encoding} (ipynb raw)"
+        except UnicodeDecodeError:
+            decoded.error = "UTF-8またはShift-JISとしてデコードできませんでした"
+        return decoded
+
+    try:
+        decoded.text, decoded.encoding = decode_text(view)
+    except UnicodeDecodeError:
+        decoded.error = "UTF-8またはShift-JISとしてデコードできませんでした"
+    return decoded
+
+
+_memo = OrderedDict()
+_memo_chars = 0
+_memo_lock = threading.Lock()
+
+
+def _memo_get(key):
+    with _memo_lock:
+        decoded = _memo.get(key)
+        if decoded is not None:
+            _memo.move_to_end(key)
+        return decoded
+
+
+def _memo_put(key, decoded):
+    global _memo_chars
+    size = len(decoded.text or "")
+    if size > MEMO_MAX_CHARS:
+        return
+    with _memo_lock:
+        if key in _memo:
+            return
+        _memo[key] = decoded
+        _memo_chars += size
+        while len(_memo) > MEMO_MAX_ENTRIES or _memo_chars > MEMO_MAX_CHARS:
+            _, evicted = _memo.popitem(last=False)
+            _memo_chars -= len(evicted.text or "")
+
+
+def clear_memo():
+    global _memo_chars
+    with _memo_lock:
+        _memo.clear()
+        _memo_chars = 0
+
+
+def decode_upload(file_name, data):
+    """アップロードされたファイル (bytes / memoryview など) をデコードした DecodedFile を返す。
+
+    同じ内容・同じファイル種別の結果は保存しておき、2回目以降はデコードせずに返す。
+    """
+    with memoryview(data) as view:
+        digest = hashlib.sha256(view).hexdigest()
+        key = (digest, file_name.endswith(".ipynb"))
+        memoized = _memo_get(key)
+        if memoized is not None:
+            return DecodedFile(**{**memoized.__dict__, "file_name": file_name, "from_memo": True})
+        decoded = _decode(file_name, view, digest)
+    _memo_put(key, decoded)
+    return decoded
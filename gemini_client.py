@@ -0,0 +1,70 @@
+"""Geminiのクライアントとモデルをプロセス全体で1度だけ作成して共有する。
+
+Streamlitは操作のたびにapp.pyを再実行するため、設定の読み込みやモデルの作成は
+st.cache_resource に載せて再実行のたびに繰り返さないようにしている。
+google.generativeai は読み込みが重いので、実際にリクエストを送るときまで import しない。
+"""
+import os
+
+import streamlit as st
+from dotenv import load_dotenv
+
+from prefix_cache import GeminiPrefixCache, LocalPrefixCache, PrefixCache, prefix_cache_mode
+from request_scheduler import PRIORITY_BACKGROUND, RequestScheduler
+
+DEFAULT_MODEL_NAME = 'gemini-2.0-flash'
+
+
+@st.cache_resource(show_spinner=False)
+def get_api_key():
+    load_dotenv()
+    return os.getenv("GOOGLE_API_KEY")
+
+
+@st.cache_resource(show_spinner=False)
+def _configured_genai():
+    import google.generativeai as genai
+    genai.configure(api_key=get_api_key())
+    return genai
+
+
+@st.cache_resource(show_spinner=False)
+def get_model(model_name=DEFAULT_MODEL_NAME):
+    """モデル名ごとに1つだけ GenerativeModel を作成し、全セッションで共有する。"""
+    genai = _configured_genai()
+    return genai.GenerativeModel(model_name)
+
+
+@st.cache_resource(show_spinner=False)
+def warm_up(model_name=DEFAULT_MODEL_NAME):
+    """モデルを作成し、短いリクエストを1回送って接続を温めておく (プロセスにつき1回)。
+
+    ほかの呼び出しと同じくスケジューラを通し、優先度の低いリクエストとしてバックグラウンドで送る。
+    失敗しても本番のリクエストには影響しないため、結果は返り値の ScheduledRequest で確認するだけにする。
+    """
+    return get_scheduler().submit(
+        lambda: get_model(model_name).generate_content("ping", generation_config={"max_output_tokens": 1}),
+        priority=PRIORITY_BACKGROUND, coalesce_key=f"warm-up:{model_name}",
+    )
+
+
+def warm_up_enabled():
+    # サーバー起動後の最初の実行でウォームアップする場合は GEMINI_WARMUP=1 を設定する
+    return os.getenv("GEMINI_WARMUP", "").lower() in ("1", "true", "yes")
+
+
+@st.cache_resource(show_spinner=False)
+def get_scheduler():
+    """全セッションの Gemini 呼び出しが通るスケジューラ (プロセスにつき1つ)。"""
+    return RequestScheduler()
+
+
+@st.cache_resource(show_spinner=False)
+def get_prefix_cache(model_name=DEFAULT_MODEL_NAME):
+    """プロンプトの固定部分のキャッシュ (GEMINI_PREFIX_CACHE で off / local / gemini を選ぶ)。"""
+    mode = prefix_cache_mode()
+    if mode == "gemini":
+        return GeminiPrefixCache(_configured_genai, model_name)
+    if mode == "local":
+        return LocalPrefixCache()
+    return PrefixCache()
@@ -0,0 +1,164 @@
+"""リクエストの各段階の処理時間やトークン数を記録する軽量な計測機能。
+
+計測しない場合は何もしない NULL_METRICS を使うので、無効時の負荷はほぼない。
+記録した内容は MetricsSink で JSONL (1リクエスト1行) と Prometheus のテキスト形式に書き出せる。
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+DEFAULT_JSONL_PATH = os.getenv("APP_METRICS_JSONL", "metrics.jsonl")
+DEFAULT_PROMETHEUS_PATH = os.getenv("APP_METRICS_PROM", "metrics.prom")
+
+# response.usage_metadata から読み取る項目
+_usage_fields = (
+    "prompt_token_count",
+    "candidates_token_count",
+    "total_token_count",
+    "cached_content_token_count",
+)
+
+
+def export_enabled():
+    # ファイルへの書き出しは APP_METRICS=1 のときだけ行う
+    return os.getenv("APP_METRICS", "").lower() in ("1", "true", "yes")
+
+
+class RequestMetrics:
+    enabled = True
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.stages = {}
+        self.values = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def mark(self, name):
+        # リクエスト開始からの経過時間を記録する (最初のチャンクまでの時間など)
+        if name not in self.values:
+            self.values[name] = time.perf_counter() - self._start
+
+    def record(self, name, value):
+        self.values[name] = value
+
+    def record_usage(self, usage_metadata):
+        if usage_metadata is None:
+            return
+        for field in _usage_fields:
+            value = getattr(usage_metadata, field, None)
+            if value is not None:
+                self.values[field] = value
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "timestamp": self.started_at,
+            "total_seconds": time.perf_counter() - self._start,
+            "stages": {name: round(seconds, 6) for name, seconds in self.stages.items()},
+            "values": self.values,
+        }
+
+
+class _NullMetrics:
+    """計測が無効なときの代わり。すべての操作が何もしない。"""
+    enabled = False
+    _context = nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+    def add_stage(self, name, seconds):
+        pass
+
+    def mark(self, name):
+        pass
+
+    def record(self, name, value):
+        pass
+
+    def record_usage(self, usage_metadata):
+        pass
+
+    def to_dict(self):
+        return {}
+
+
+NULL_METRICS = _NullMetrics()
+
+
+def start_request(kind, enabled):
+    return RequestMetrics(kind) if enabled else NULL_METRICS
+
+
+class MetricsSink:
+    """計測結果をファイルに追記・集計する (プロセス全体で共有)。"""
+
+    def __init__(self, jsonl_path=DEFAULT_JSONL_PATH, prometheus_path=DEFAULT_PROMETHEUS_PATH):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._stage_sums = {}
+        self._stage_counts = {}
+        self._value_sums = {}
+
+    def write(self, metrics):
+        if not metrics.enabled:
+            return
+        record = metrics.to_dict()
+        with self._lock:
+            with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            kind = record["kind"]
+            self._requests[kind] = self._requests.get(kind, 0) + 1
+            stages = dict(record["stages"], total=record["total_seconds"])
+            for name, seconds in stages.items():
+                key = (kind, name)
+                self._stage_sums[key] = self._stage_sums.get(key, 0.0) + seconds
+                self._stage_counts[key] = self._stage_counts.get(key, 0) + 1
+            for name, value in record["values"].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    key = (kind, name)
+                    self._value_sums[key] = self._value_sums.get(key, 0) + value
+            self._write_prometheus()
+
+    def _write_prometheus(self):
+        lines = [
+            "# HELP app_requests_total Number of instrumented requests.",
+            "# TYPE app_requests_total counter",
+        ]
+        for kind, count in sorted(self._requests.items()):
+            lines.append(f'app_requests_total{{kind="{kind}"}} {count}')
+        lines += [
+            "# HELP app_stage_seconds Time spent in each request stage.",
+            "# TYPE app_stage_seconds summary",
+        ]
+        for (kind, name), total in sorted(self._stage_sums.items()):
+            labels = f'kind="{kind}",stage="{name}"'
+            lines.append(f"app_stage_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"app_stage_seconds_count{{{labels}}} {self._stage_counts[(kind, name)]}")
+        lines += [
+            "# HELP app_request_value_total Sum of recorded sizes, token counts and marks.",
+            "# TYPE app_request_value_total counter",
+        ]
+        for (kind, name), total in sorted(self._value_sums.items()):
+            lines.append(f'app_request_value_total{{kind="{kind}",name="{name}"}} {total}')
+        # 読み取り側が書きかけのファイルを見ないよう、一時ファイルから置き換える
+        temp_path = self.prometheus_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.prometheus_path)
@@ -0,0 +1,149 @@
+"""プロンプトの固定部分 (prefix) をキャッシュし、可変部分だけで回答を依頼するための仕組み。
+
+PrefixCache.prepare() が、そのテンプレートで使うモデルと、prefix を本文に含めて送る必要があるかを返す。
+    PrefixCache        : キャッシュしない (常に全文を送る)
+    LocalPrefixCache   : 全文を送りつつ、2回目以降の prefix をキャッシュ済みとして数える (テスト・計測用)
+    GeminiPrefixCache  : Gemini のコンテキストキャッシュに prefix を登録し、可変部分だけを送る
+どれを使うかは GEMINI_PREFIX_CACHE (off / local / gemini) で選ぶ。
+"""
+import datetime
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+DEFAULT_TTL_SECONDS = int(float(os.getenv("GEMINI_PREFIX_CACHE_TTL_MINUTES", "60")) * 60)
+# コンテキストキャッシュに登録できる最小のトークン数 (モデルによって異なる)。これより短い prefix は登録しない
+DEFAULT_MIN_TOKENS = int(os.getenv("GEMINI_PREFIX_CACHE_MIN_TOKENS", "4096"))
+# 登録に失敗した prefix を、再び登録しようとするまでの時間
+RETRY_SECONDS = 600
+
+
+def prefix_cache_mode():
+    mode = os.getenv("GEMINI_PREFIX_CACHE", "off").lower()
+    return mode if mode in ("local", "gemini") else "off"
+
+
+@dataclass
+class PrefixLookup:
+    # generate_content を呼ぶモデル
+    model: object
+    # True なら prefix も本文に含めて送る (False なら可変部分だけを送る)
+    send_prefix: bool
+    # キャッシュ済みとして扱われる見込みのトークン数
+    cached_tokens: int = 0
+
+
+def cached_token_ratio(lookup, usage_metadata=None, prompt_tokens=0):
+    """入力トークンのうちキャッシュ済みの割合。usage_metadata に値があればそれを優先する。"""
+    cached = getattr(usage_metadata, "cached_content_token_count", None) or lookup.cached_tokens
+    total = getattr(usage_metadata, "prompt_token_count", None) or prompt_tokens
+    return min(1.0, cached / total) if total else 0.0
+
+
+class PrefixCache:
+    """キャッシュしない実装。ほかの実装もこのインターフェースに合わせる。"""
+
+    def prepare(self, template, model):
+        return PrefixLookup(model, send_prefix=True)
+
+    def stats(self):
+        return {}
+
+
+class LocalPrefixCache(PrefixCache):
+    """Gemini を使わずに prefix キャッシュの効果を見積もるための代わり。
+
+    送る内容は変えず、一度見た prefix を TTL の間だけキャッシュ済みとして数える。
+    """
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=256, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._clock = clock
+        self._expires = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def prepare(self, template, model):
+        now = self._clock()
+        with self._lock:
+            expires_at = self._expires.get(template.prefix_key)
+            hit = expires_at is not None and expires_at > now
+            self._expires[template.prefix_key] = now + self.ttl_seconds
+            self._expires.move_to_end(template.prefix_key)
+            while len(self._expires) > self.max_entries:
+                self._expires.popitem(last=False)
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+        return PrefixLookup(model, send_prefix=True, cached_tokens=template.prefix_tokens if hit else 0)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._expires), "hits": self._hits, "misses": self._misses}
+
+
+@dataclass
+class _CachedPrefix:
+    model: object
+    expires_at: float
+
+
+class GeminiPrefixCache(PrefixCache):
+    """prefix を Gemini のコンテキストキャッシュ (CachedContent) に登録して再利用する。
+
+    load_genai() は設定済みの google.generativeai を返す関数。登録は prefix ごとに1回だけ行い、
+    期限が近づいたら登録し直す。登録できない場合は全文を送る通常の呼び出しに戻す。
+    """
+
+    def __init__(self, load_genai, model_name, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 min_tokens=DEFAULT_MIN_TOKENS, clock=time.time):
+        self.load_genai = load_genai
+        self.model_name = model_name
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self._clock = clock
+        self._entries = {}
+        self._failed_until = {}
+        self._lock = threading.Lock()
+        self._created = 0
+        self._hits = 0
+
+    def prepare(self, template, model):
+        if template.prefix_tokens < self.min_tokens:
+            return PrefixLookup(model, send_prefix=True)
+        key = template.prefix_key
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            # 期限切れの直前に使うと呼び出し中に消えるため、余裕を持って登録し直す
+            if entry is not None and entry.expires_at - 60 > now:
+                self._hits += 1
+                return PrefixLookup(entry.model, send_prefix=False, cached_tokens=template.prefix_tokens)
+            if self._failed_until.get(key, 0) > now:
+                return PrefixLookup(model, send_prefix=True)
+        try:
+            genai = self.load_genai()
+            cached_content = genai.caching.CachedContent.create(
+                model=self.model_name,
+                display_name=f"prompt-prefix-{key[:16]}",
+                contents=[template.prefix],
+                ttl=datetime.timedelta(seconds=self.ttl_seconds),
+            )
+            cached_model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+        except Exception:
+            with self._lock:
+                self._failed_until[key] = now + RETRY_SECONDS
+            return PrefixLookup(model, send_prefix=True)
+        with self._lock:
+            self._entries[key] = _CachedPrefix(cached_model, now + self.ttl_seconds)
+            self._created += 1
+        return PrefixLookup(cached_model, send_prefix=False, cached_tokens=template.prefix_tokens)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "created": self._created, "hits": self._hits}
@@ -0,0 +1,127 @@
+"""回答を依頼するプロンプトのテンプレート。
+
+プロンプトは、言語・目的・技術レベルの組み合わせだけで決まる固定部分 (prefix) と、
+名前・質問・ファイルなどの可変部分 (suffix) に分け、可変部分を必ず最後に置く。
+固定部分は 5言語 × 2目的 × 4レベル の全組み合わせを import 時に1度だけ組み立てておくので、
+依頼のたびに指示文を組み立て直さず、同じ prefix を Gemini のコンテキストキャッシュでも再利用できる。
+"""
+import hashlib
+from dataclasses import dataclass
+from functools import lru_cache
+
+from context_builder import estimate_tokens
+
+LANGUAGES = ["Python", "HTML", "CSS", "JavaScript", "SQL"]
+GOALS = ["困りごとの解決", "プログラミング学習"]
+LEVELS = ["初学者", "何となくコードを読める", "自分でコーディングできる", "自力でバグ解消できる"]
+
+# 指示文を変えたら更新する (キャッシュ済みの prefix と区別するため)
+TEMPLATE_VERSION = "1"
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    language: str
+    goal: str
+    level: str
+    prefix: str
+    # 質問が空のときに代わりに使う依頼文
+    default_question: str
+    prefix_key: str
+    prefix_tokens: int
+
+
+@dataclass(frozen=True)
+class RenderedPrompt:
+    template: PromptTemplate
+    suffix: str
+
+    @property
+    def text(self):
+        return self.template.prefix + self.suffix
+
+
+def _instructions(language, goal, level):
+    if goal == "困りごとの解決":
+        return [
+            "- ユーザーの質問や困りごと、提供されたファイル情報（もしあれば）に基づいて、具体的な解決策やコード例を提示してください。",
+            "- **重要:** 回答の最後に、参考文献として役立つ可能性のあるWebサイトのURLを必ず3つから5つ提示してください。リスト形式などが望ましいです。",
+            "- 回答はマークダウン形式で、ユーザーが読みやすいように記述してください。",
+        ]
+    if goal == "プログラミング学習":
+        return [
+            f"- {language}の{level}レベルのユーザー向けに、質問やファイル情報（もしあれば）に関連する基本的な概念や書き方を解説してください。",
+            "- **重要:** 解説の最後に、内容の理解度を確認するための簡単なクイズを1つ作成してください。",
+            "- **クイズの形式:** 必ず応答の最後に、改行を挟んでから `Q: [質問文]` の形式で質問文のみを提示してください。",
+            "- **絶対に、絶対に、絶対にクイズの解答や正解を示唆するヒントをユーザー向けの出力に含めないでください。**",
+            '- **採点用の解答キー:** `Q:` の行の次の行に、採点専用の解答キーを1行のHTMLコメントとして `<!--ANSWER_KEY {"answer": "模範解答", "accepted": ["正解として認める別の表記"], "concept": "このクイズで確認したい考え方の要約"} -->` の形式で出力してください。このコメントはユーザーには表示されません。',
+            "- 回答はマークダウン形式で、ユーザーが読みやすいように記述してください。",
+        ]
+    return []
+
+
+def _default_question(language, goal, level):
+    if goal == "困りごとの解決":
+        return "具体的な困りごとが入力されていません。アップロードされたファイル情報（もしあれば）や選択された言語、レベルから想定される一般的な問題や、その言語の基本的な使い方について解説してください。"
+    if goal == "プログラミング学習":
+        return f"具体的な質問が入力されていません。{language}の基本的な概念や、{level}レベルのあなたが学び始めると良いトピックについて解説してください。"
+    return ""
+
+
+def compile_template(language, goal, level):
+    lines = [
+        "プログラミング学習AIです。",
+        "あなたの現在の状況と言語、目的に合わせてサポートします。",
+        f"対象言語: {language}",
+        f"目的: {goal}",
+        f"技術レベル: {level}",
+        "\n# 回答生成のための指示:",
+        *_instructions(language, goal, level),
+        "\n以下の追加情報も考慮してください。",
+    ]
+    prefix = "\n".join(lines) + "\n"
+    prefix_key = hashlib.sha256(f"{TEMPLATE_VERSION}\0{prefix}".encode("utf-8")).hexdigest()
+    return PromptTemplate(
+        language, goal, level, prefix, _default_question(language, goal, level), prefix_key, estimate_tokens(prefix)
+    )
+
+
+TEMPLATES = {
+    (language, goal, level): compile_template(language, goal, level)
+    for language in LANGUAGES for goal in GOALS for level in LEVELS
+}
+
+
+@lru_cache(maxsize=64)
+def _compile_other(language, goal, level):
+    return compile_template(language, goal, level)
+
+
+def get_template(language, goal, level):
+    """組み立て済みのテンプレートを返す (一覧にない組み合わせはその場で1度だけ組み立てる)。"""
+    template = TEMPLATES.get((language, goal, level))
+    if template is None:
+        template = _compile_other(language, goal, level)
+    return template
+
+
+def render_prompt(template, user_name="", problem_details="", file_info="", file_text=None):
+    """テンプレートの後ろに可変部分 (名前・質問・ファイル) をつないだプロンプトを返す。"""
+    user_label = f"{user_name}さん" if user_name else "ユーザー"
+    parts = []
+    if user_name:
+        parts.append(f"\n# ユーザー名: {user_name}")
+    if problem_details:
+        parts.append(f"\n# {user_label}からの質問や困りごと:\n{problem_details}")
+    elif template.default_question:
+        parts.append(f"\n# {user_label}からの具体的な質問:\n{template.default_question}")
+    # ファイル情報と内容は最後に置く
+    if file_info:
+        parts.append(f"\n--- {user_label}が提供したファイル情報 ---")
+        parts.append(file_info)
+        if file_text is not None:
+            parts.append("\n--- ファイル内容 ---")
+            parts.append(file_text)
+            parts.append("--- ファイル内容ここまで ---")
+        parts.append("--- ファイル情報ここまで ---")
+    return RenderedPrompt(template, "\n".join(parts))
@@ -0,0 +1,165 @@
+"""Geminiの回答から解説文とクイズを取り出す処理。"""
+import json
+import re
+
+# クイズ行の判定パターン (行頭の空白は除いて判定する)
+QUIZ_MARKERS = ("Q:", "質問:", "問題:", "クイズ：")
+quiz_pattern = re.compile(r"^(Q:|質問:|問題:|クイズ：)\s*", re.IGNORECASE)
+# 採点用の解答キー。ユーザーには表示せず、回答の最後にHTMLコメントとして出力させる
+answer_key_start_pattern = re.compile(r"<!--\s*ANSWER_KEY")
+answer_key_pattern = re.compile(r"<!--\s*ANSWER_KEY\s*(\{.*?\})\s*-->", re.DOTALL)
+_hold_markers_lower = tuple(marker.lower() for marker in QUIZ_MARKERS) + ("<!--",)
+
+
+# クイズ抽出関数 (応答全体を受け取る従来版)
+def extract_quiz(response_text):
+    lines = response_text.strip().split('\n')
+    quiz_question = None
+    explanation_lines = []
+    found_quiz = False
+    temp_explanation = []
+    for i, line in enumerate(lines):
+        stripped_line = line.strip()
+        if quiz_pattern.match(stripped_line):
+             quiz_question = line
+             found_quiz = True
+             explanation_lines.extend(temp_explanation)
+             temp_explanation = []
+        elif found_quiz:
+             pass
+        else:
+             temp_explanation.append(line)
+    if not found_quiz:
+        explanation_lines.extend(temp_explanation)
+    explanation_text = "\n".join(explanation_lines).strip()
+    if found_quiz and not explanation_text:
+         q_index = -1
+         for i, line in enumerate(lines):
+              if quiz_pattern.match(line.strip()):
+                   q_index = i
+                   break
+         if q_index > 0:
+             explanation_text = "\n".join(lines[:q_index]).strip()
+         else:
+             explanation_text = ""
+    if not quiz_question:
+        explanation_text = response_text.strip()
+    return explanation_text, quiz_question
+
+
+def split_answer_key(response_text):
+    """回答から解答キーのコメントを取り除き、(残りのテキスト, 解答キーの辞書 or None) を返す。"""
+    answer_key = None
+    match = answer_key_pattern.search(response_text)
+    if match:
+        try:
+            parsed = json.loads(match.group(1))
+            if isinstance(parsed, dict):
+                answer_key = parsed
+                # concept は表示や採点の文面にそのまま使うので、文字列以外 (リストなど) は空にする
+                concept = parsed.get("concept")
+                answer_key["concept"] = str(concept).strip() if isinstance(concept, (str, int, float)) else ""
+        except json.JSONDecodeError:
+            pass
+    # 解析できなかった場合も、ユーザーに見えないようコメント部分は取り除く
+    visible_text = answer_key_pattern.sub("", response_text)
+    # 閉じていない解答キーは、それ以降をすべて取り除く
+    unterminated = answer_key_start_pattern.search(visible_text)
+    if unterminated:
+        visible_text = visible_text[:unterminated.start()]
+    return visible_text, answer_key
+
+
+def parse_response(response_text):
+    """回答全体を (解答キーを除いた回答, 解説, クイズ, 解答キー) に分ける。"""
+    visible_text, answer_key = split_answer_key(response_text)
+    explanation_text, quiz_question = extract_quiz(visible_text)
+    return visible_text, explanation_text, quiz_question, answer_key
+
+
+def _may_become_quiz_line(partial_line):
+    # 書きかけの行が、続きを受信するとクイズ行になり得るかを判定する
+    head = partial_line.lstrip().lower()
+    if not head:
+        return True
+    return any(marker.startswith(head) or head.startswith(marker) for marker in _hold_markers_lower)
+
+
+class StreamingQuizExtractor:
+    """ストリーミング中のチャンクを受け取り、表示してよい解説部分だけを返す。
+
+    クイズ行 (Q: など) や解答キーを検出した時点で解説の表示を打ち切るため、
+    クイズ文や解答が解説の中に表示されることはない。最終的な解説とクイズは
+    finish() で parse_response と同じ結果として取得する。
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._visible_lines = []
+        self._pending = ""
+        self.quiz_found = False
+        # visible_text() の結果を使い回すためのキャッシュ (長い回答で毎回全体を連結しないように)
+        self._joined = ""
+        self._joined_count = 0
+        self._cached_key = None
+        self._cached_text = ""
+
+    def feed(self, chunk_text):
+        """チャンクを追加する。表示してよい解説が増えた可能性があれば True を返す。
+
+        表示内容は visible_text() で取得する。チャンクごとに全文を組み立てると
+        長い回答で処理時間が2乗で増えるため、ここでは組み立てない。
+        """
+        self._chunks.append(chunk_text)
+        if self.quiz_found:
+            return False
+
+        lines = (self._pending + chunk_text).split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            stripped_line = line.strip()
+            if quiz_pattern.match(stripped_line):
+                self.quiz_found = True
+            else:
+                # 解答キーは行の途中から始まることもあるので、その手前までを表示する
+                key_start = answer_key_start_pattern.search(line)
+                if key_start:
+                    if line[:key_start.start()].strip():
+                        self._visible_lines.append(line[:key_start.start()])
+                    self.quiz_found = True
+            if self.quiz_found:
+                self._pending = ""
+                break
+            self._visible_lines.append(line)
+        return True
+
+    def visible_text(self):
+        """現時点で表示してよい解説テキストを返す。"""
+        # 書きかけの行に "<" があれば、解答キーのコメントが始まる途中かもしれないので行末まで待つ
+        show_pending = (
+            not self.quiz_found and "<" not in self._pending and not _may_become_quiz_line(self._pending)
+        )
+        key = (len(self._visible_lines), self._pending if show_pending else None)
+        if key == self._cached_key:
+            return self._cached_text
+        if self._joined_count < len(self._visible_lines):
+            new_text = "\n".join(self._visible_lines[self._joined_count:])
+            self._joined = self._joined + "\n" + new_text if self._joined_count else new_text
+            self._joined_count = len(self._visible_lines)
+        text = self._joined
+        if show_pending:
+            text = text + "\n" + self._pending if self._joined_count else self._pending
+        self._cached_key = key
+        self._cached_text = text.strip()
+        return self._cached_text
+
+    @property
+    def full_text(self):
+        return "".join(self._chunks)
+
+    def finish(self):
+        """受信した全文から (解答キーを除いた回答, 解説, クイズ, 解答キー) を返す。
+
+        一括で受信した場合の parse_response と同じ結果になる。
+        """
+        return parse_response(self.full_text)
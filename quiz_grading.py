@@ -0,0 +1,124 @@
+"""クイズの採点。明らかな一致はローカルで判定し、それ以外は短いプロンプトでGeminiに依頼する。"""
+import re
+import unicodedata
+from dataclasses import dataclass
+from fractions import Fraction
+
+_whitespace = re.compile(r"\s+")
+# 答えの前後に付きがちな記号 (引用符、バッククォート、句読点など)。
+# 「.」「,」は数値の一部 (.5 や 1,000) のことがあるので、数値らしい答えからは取り除かない
+_surrounding_marks = "\"'`「」『』。、!！?？ "
+_number_marks = ".,"
+_numeric_like = re.compile(r"^[+-]?[\d.,]*\d[\d.,]*(e[+-]?\d+)?$|^[+-]?\d+/\d+$")
+_number_pattern = re.compile(r"^[+-]?(\d+(\.\d*)?|\.\d+)(e[+-]?\d+)?$|^[+-]?\d+/\d+$")
+# 3桁区切りのカンマ (1,000 / 12,345.6)。これ以外のカンマ (1,5 など) は小数点か区切りか判断できない
+_thousands_pattern = re.compile(r"^[+-]?\d{1,3}(,\d{3})+(\.\d*)?$")
+
+
+@dataclass
+class LocalGrade:
+    correct: bool
+    feedback: str
+
+
+def normalize_answer(text):
+    # 全角/半角・大文字/小文字・空白の違いを無視して比較できる形にする
+    text = unicodedata.normalize("NFKC", text or "").casefold().strip()
+    text = _whitespace.sub("", text.strip(_surrounding_marks))
+    if not _numeric_like.match(text):
+        text = text.strip(_surrounding_marks + _number_marks)
+    return text
+
+
+def parse_number(text):
+    """数値として読める答えを Fraction で返す。読めない・読み方が曖昧な場合は None。"""
+    normalized = normalize_answer(text)
+    if "," in normalized:
+        if not _thousands_pattern.match(normalized):
+            return None
+        normalized = normalized.replace(",", "")
+    if not _number_pattern.match(normalized):
+        return None
+    try:
+        return Fraction(normalized)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def accepted_answers(answer_key):
+    answers = []
+    if not answer_key:
+        return answers
+    answer = answer_key.get("answer")
+    if isinstance(answer, (str, int, float)):
+        answers.append(str(answer))
+    accepted = answer_key.get("accepted") or []
+    if isinstance(accepted, list):
+        answers.extend(str(item) for item in accepted if isinstance(item, (str, int, float)))
+    return [answer for answer in answers if normalize_answer(answer)]
+
+
+def answer_concept(answer_key):
+    """解答キーの concept を文字列で返す (モデルが文字列以外を返した場合は空文字)。"""
+    concept = (answer_key or {}).get("concept")
+    return str(concept).strip() if isinstance(concept, (str, int, float)) else ""
+
+
+def grade_locally(user_answer, answer_key):
+    """明らかに判定できる場合だけ LocalGrade を返し、判断が必要な場合は None を返す。
+
+    正規化した文字列または数値が正解のいずれかと一致すれば正解とする。
+    正解がすべて数値で、ユーザーの解答も数値なのに一致しない場合は不正解とする。
+    """
+    answers = accepted_answers(answer_key)
+    if not answers:
+        return None
+    concept = answer_concept(answer_key)
+    normalized_user = normalize_answer(user_answer)
+    user_number = parse_number(user_answer)
+    answer_numbers = [parse_number(answer) for answer in answers]
+
+    matched = any(normalize_answer(answer) == normalized_user for answer in answers)
+    if not matched and user_number is not None:
+        matched = any(number is not None and number == user_number for number in answer_numbers)
+    if matched:
+        feedback = "- **採点結果:** 正解です！"
+        if concept:
+            feedback += f"\n- **解説:** {concept}"
+        return LocalGrade(True, feedback)
+
+    if user_number is not None and all(number is not None for number in answer_numbers):
+        # concept には答えそのものが書かれていることがあるので、不正解のときは示さない
+        feedback = (
+            "- **採点結果:** 不正解です\n- **解説:** 数値が正解と一致しませんでした。"
+            "解説をもう一度読み、計算や処理の流れをたどってみましょう。"
+        )
+        return LocalGrade(False, feedback)
+    return None
+
+
+def build_grading_prompt(quiz_question, answer_key, user_answer, user_name):
+    """解答キーを使った採点用の短いプロンプト。解説全文は送らない。"""
+    answers = accepted_answers(answer_key)
+    concept = answer_concept(answer_key)
+    return f"""
+あなたはプログラミングクイズの採点者です。
+以下の「クイズ」「採点基準」と「ユーザー ({user_name}) の解答」を比較し、ユーザーの解答がクイズの意図に合っているか、正解と言えるかを判断してください。
+判断結果と、簡単な解説（なぜ正解/不正解なのか、正解の考え方など）をユーザーにフィードバックしてください。
+
+**重要:** 採点基準の模範解答そのものは、フィードバックに記述しないでください。あくまでユーザーの解答に対する評価と、正解に至る考え方を説明するに留めてください。
+
+# クイズ:
+{quiz_question}
+
+# 採点基準 (ユーザーには非公開):
+- 確認したい考え方: {concept or '（記載なし）'}
+- 模範解答: {' / '.join(answers) if answers else '（記載なし）'}
+
+# ユーザー ({user_name}) の解答:
+{user_answer}
+
+# フィードバック形式（例）:
+- **採点結果:** 正解です！ / 惜しい！もう少しです / 不正解です
+- **解説:** [なぜその評価なのか、正解の考え方などを簡潔に記述]
+"""
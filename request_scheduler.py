@@ -0,0 +1,247 @@
+"""Gemini API への呼び出しをプロセス全体でまとめて管理するスケジューラ。
+
+- トークンバケットで1分あたりのリクエスト数をクォータ内に抑える
+- 同時に実行する呼び出し数に上限を設ける
+- 429 や 503 などの一時的なエラーは、ジッター付きの指数バックオフで再試行する (再試行もトークンを使う)
+- 優先度の高いリクエスト (採点) を、新しい解説の生成より先に処理する。
+  1つのディスパッチャがトークンを取ってからキューの先頭を取り出し、ワーカーに渡す
+- 同じキーの処理中のリクエストは1回の呼び出しにまとめる
+
+Gemini に依存しない作りにしてあるので、偽のモデルを使ったテストやベンチマークにもそのまま使える。
+"""
+import heapq
+import itertools
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+PRIORITY_GRADING = 0
+PRIORITY_EXPLANATION = 10
+PRIORITY_BACKGROUND = 20
+
+DEFAULT_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "15"))
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+DEFAULT_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+
+# 再試行してよいエラー (google.api_core.exceptions のクラス名と HTTP ステータス)
+_transient_error_names = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+    "DeadlineExceeded", "InternalServerError", "GatewayTimeout",
+}
+_transient_status_codes = {429, 500, 502, 503, 504}
+
+
+def is_transient_error(error):
+    if type(error).__name__ in _transient_error_names:
+        return True
+    code = getattr(error, "code", None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    return getattr(code, "value", code) in _transient_status_codes
+
+
+class TokenBucket:
+    """rate_per_second の速度でトークンが溜まり、最大 capacity 個まで貯められるバケット。"""
+
+    def __init__(self, rate_per_second, capacity, clock=time.monotonic):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """トークンを1つ取れたら 0 を、取れなければ次に取れるまでの秒数を返す。"""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_second)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate_per_second
+
+
+class ScheduledRequest:
+    """スケジューラに登録された1件のリクエスト。同じキーで合流した呼び出し元とも共有される。"""
+
+    def __init__(self, func, priority, coalesce_key, clock):
+        self.func = func
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.future = Future()
+        self.enqueued_at = clock()
+        self.started_at = None
+        # 同じ優先度の中での順番 (再試行でキューに戻しても変えない)
+        self.sequence = None
+        self.attempts = 0
+        self.coalesced = 0
+        self._clock = clock
+
+    @property
+    def wait_seconds(self):
+        # キューで待った時間 (まだ開始していなければ現在までの時間)
+        end = self.started_at if self.started_at is not None else self._clock()
+        return end - self.enqueued_at
+
+    def done(self):
+        return self.future.done()
+
+    def wait(self, timeout=None):
+        try:
+            self.future.exception(timeout=timeout)
+        except FutureTimeoutError:
+            pass
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout=timeout)
+
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, burst=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, max_retries=DEFAULT_MAX_RETRIES,
+                 base_delay=1.0, max_delay=30.0,
+                 clock=time.monotonic, sleep=time.sleep, jitter=random.random):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._bucket = TokenBucket(requests_per_minute / 60.0, burst or max(1, max_concurrency), clock)
+        self._clock = clock
+        self._sleep = sleep
+        self._jitter = jitter
+        self._queue = []
+        self._sequence = itertools.count()
+        self._in_flight = {}
+        self._running = 0
+        # ディスパッチャがトークンを取ってから取り出したリクエストを、ワーカーに渡すためのキュー
+        self._ready = queue.SimpleQueue()
+        self._dispatcher = None
+        self._workers = []
+        self._condition = threading.Condition()
+        self._completed = 0
+        self._total_wait = 0.0
+        self._retries = 0
+
+    def submit(self, func, priority=PRIORITY_EXPLANATION, coalesce_key=None):
+        """func() の実行を予約し、ScheduledRequest を返す。
+
+        coalesce_key が同じリクエストが待機中または実行中なら、新しく呼ばずにそれを返す。
+        """
+        with self._condition:
+            if coalesce_key is not None and coalesce_key in self._in_flight:
+                request = self._in_flight[coalesce_key]
+                request.coalesced += 1
+                return request
+            request = ScheduledRequest(func, priority, coalesce_key, self._clock)
+            request.sequence = next(self._sequence)
+            if coalesce_key is not None:
+                self._in_flight[coalesce_key] = request
+            heapq.heappush(self._queue, (priority, request.sequence, request))
+            self._ensure_threads()
+            self._condition.notify_all()
+            return request
+
+    def run(self, func, priority=PRIORITY_EXPLANATION, coalesce_key=None, timeout=None):
+        return self.submit(func, priority, coalesce_key).result(timeout=timeout)
+
+    def position(self, request):
+        """キューの中で何番目に処理されるか (1始まり)。実行中・完了済みなら 0。"""
+        with self._condition:
+            if request.started_at is not None:
+                return 0
+            for priority, sequence, queued in self._queue:
+                if queued is request:
+                    key = (priority, sequence)
+                    break
+            else:
+                return 0
+            return 1 + sum(1 for item in self._queue if item[:2] < key)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "queue_depth": len(self._queue),
+                "running": self._running,
+                "completed": self._completed,
+                "retries": self._retries,
+                "average_wait_seconds": self._total_wait / self._completed if self._completed else 0.0,
+            }
+
+    def _ensure_threads(self):
+        # 呼び出し元がロックを持っている前提。必要になった時点でディスパッチャとワーカーを起動する
+        if self._dispatcher is None or not self._dispatcher.is_alive():
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="gemini-dispatcher", daemon=True)
+            self._dispatcher.start()
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        while len(self._workers) < self.max_concurrency:
+            worker = threading.Thread(target=self._worker_loop, name="gemini-scheduler", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _dispatch_loop(self):
+        # 空きがあるときにだけトークンを取り、取れた時点でいちばん優先度の高いリクエストを取り出す。
+        # トークンを待っている間に届いた採点も、先に届いた解説より先に実行される
+        while True:
+            with self._condition:
+                while not self._queue or self._running >= self.max_concurrency:
+                    self._condition.wait()
+            self._acquire_rate_token()
+            with self._condition:
+                # キューから取り出すのはディスパッチャだけなので、待っている間に空になることはない
+                _, _, request = heapq.heappop(self._queue)
+                if request.started_at is None:
+                    request.started_at = self._clock()
+                self._running += 1
+            self._ready.put(request)
+
+    def _worker_loop(self):
+        while True:
+            request = self._ready.get()
+            finished = True
+            try:
+                finished = self._execute(request)
+            finally:
+                with self._condition:
+                    self._running -= 1
+                    if finished:
+                        self._completed += 1
+                        self._total_wait += request.wait_seconds
+                        if request.coalesce_key is not None:
+                            self._in_flight.pop(request.coalesce_key, None)
+                    else:
+                        # 再試行はキューに戻し、改めてトークンを取ってから実行する
+                        heapq.heappush(self._queue, (request.priority, request.sequence, request))
+                    self._condition.notify_all()
+
+    def _acquire_rate_token(self):
+        while True:
+            delay = self._bucket.try_acquire()
+            if delay <= 0:
+                return
+            self._sleep(delay)
+
+    def _execute(self, request):
+        """1回だけ呼び出す。結果が確定したら True、再試行する場合はバックオフしてから False を返す。"""
+        request.attempts += 1
+        try:
+            result = request.func()
+        except Exception as e:
+            if request.attempts > self.max_retries or not is_transient_error(e):
+                request.future.set_exception(e)
+                return True
+            delay = min(self.max_delay, self.base_delay * 2 ** (request.attempts - 1))
+            with self._condition:
+                self._retries += 1
+            self._sleep(delay / 2 + self._jitter() * delay / 2)
+            return False
+        request.future.set_result(result)
+        return True
@@ -0,0 +1,214 @@
+"""セッションごとの大きなテキスト (Geminiの回答など) を圧縮して保持するストア。
+
+st.session_state には小さなハンドル (StoredResponse) だけを置き、本体はここに1度だけ保存する。
+同じ内容は全セッションで共有され、メモリの上限を超えた分は古いものから
+ローカルのSQLiteへ退避する (読み出されたら再びメモリに戻す)。
+ブラウザを閉じただけのセッションは解放されないため、最後の利用から disk_ttl_seconds を過ぎた
+セッションは解放したものとして扱う。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+
+DEFAULT_STORE_PATH = os.getenv("SESSION_STORE_PATH", "session_store.sqlite3")
+DEFAULT_MEMORY_LIMIT = int(float(os.getenv("SESSION_STORE_MEMORY_MB", "64")) * 1024 * 1024)
+DEFAULT_SESSION_LIMIT = int(float(os.getenv("SESSION_STORE_SESSION_KB", "512")) * 1024)
+# 退避先に残ったまま参照されないデータ・使われていないセッションを削除するまでの時間
+DEFAULT_DISK_TTL_SECONDS = int(float(os.getenv("SESSION_STORE_DISK_TTL_HOURS", "24")) * 3600)
+
+
+@dataclass(frozen=True)
+class StoredResponse:
+    """st.session_state に置くハンドル。解説は回答本体の中の位置として持つ。"""
+    blob_id: str
+    explanation_start: int
+    explanation_end: int
+    # 解説が回答の一部として見つからなかった場合だけ、別に保存した解説のID
+    explanation_blob_id: str = None
+
+
+class SessionStore:
+    def __init__(self, path=DEFAULT_STORE_PATH, memory_limit=DEFAULT_MEMORY_LIMIT,
+                 session_limit=DEFAULT_SESSION_LIMIT, disk_ttl_seconds=DEFAULT_DISK_TTL_SECONDS,
+                 clock=time.time):
+        self.memory_limit = memory_limit
+        self.session_limit = session_limit
+        self.disk_ttl_seconds = disk_ttl_seconds
+        self._clock = clock
+        # blob_id -> 圧縮済みデータ (参照が新しいものほど後ろ)
+        self._blobs = OrderedDict()
+        self._memory_bytes = 0
+        self._refs = {}
+        self._sessions = {}
+        # session_id -> 最後に使われた時刻
+        self._last_access = {}
+        self._spilled = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                " blob_id TEXT PRIMARY KEY, data BLOB NOT NULL, last_access REAL NOT NULL)"
+            )
+            # ハンドルはプロセスの再起動で失われるため、前回のデータは残さない
+            self._conn.execute("DELETE FROM blobs")
+
+    def put_text(self, session_id, text):
+        """text を保存して blob_id を返す。同じ内容が保存済みなら共有する。"""
+        encoded = text.encode("utf-8")
+        blob_id = hashlib.sha256(encoded).hexdigest()
+        with self._lock:
+            self._expire_idle_sessions(session_id)
+            self._refs.setdefault(blob_id, set()).add(session_id)
+            self._sessions.setdefault(session_id, set()).add(blob_id)
+            if blob_id in self._blobs:
+                self._blobs.move_to_end(blob_id)
+            elif not self._promote(blob_id):
+                self._add_to_memory(blob_id, zlib.compress(encoded))
+            self._enforce_limits(session_id)
+        return blob_id
+
+    def get_text(self, blob_id):
+        """保存したテキストを返す。解放済みなどで見つからない場合は None。"""
+        with self._lock:
+            data = self._blobs.get(blob_id)
+            if data is not None:
+                self._blobs.move_to_end(blob_id)
+            elif self._promote(blob_id):
+                data = self._blobs[blob_id]
+                self._enforce_global_limit()
+            else:
+                return None
+        return zlib.decompress(data).decode("utf-8")
+
+    def save_response(self, session_id, response_text, explanation_text):
+        blob_id = self.put_text(session_id, response_text)
+        start = response_text.find(explanation_text) if explanation_text else 0
+        if start == -1:
+            explanation_blob_id = self.put_text(session_id, explanation_text)
+            return StoredResponse(blob_id, 0, 0, explanation_blob_id)
+        return StoredResponse(blob_id, start, start + len(explanation_text or ""))
+
+    def load_response(self, handle):
+        if handle is None:
+            return None
+        return self.get_text(handle.blob_id)
+
+    def load_explanation(self, handle):
+        if handle is None:
+            return None
+        if handle.explanation_blob_id:
+            return self.get_text(handle.explanation_blob_id)
+        response_text = self.get_text(handle.blob_id)
+        if response_text is None:
+            return None
+        return response_text[handle.explanation_start:handle.explanation_end]
+
+    def touch(self, session_id):
+        """セッションが使われていることを記録する (再実行のたびに呼ぶ)。"""
+        with self._lock:
+            self._expire_idle_sessions(session_id)
+
+    def release_session(self, session_id):
+        """セッションが参照しているデータを解放する (他から参照されていなければ削除)。"""
+        with self._lock:
+            self._last_access.pop(session_id, None)
+            for blob_id in self._sessions.pop(session_id, set()):
+                refs = self._refs.get(blob_id)
+                if refs is None:
+                    continue
+                refs.discard(session_id)
+                if not refs:
+                    del self._refs[blob_id]
+                    data = self._blobs.pop(blob_id, None)
+                    if data is not None:
+                        self._memory_bytes -= len(data)
+                    with self._conn:
+                        self._conn.execute("DELETE FROM blobs WHERE blob_id = ?", (blob_id,))
+
+    def stats(self):
+        with self._lock:
+            disk_count = self._conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+            return {
+                "sessions": len(self._sessions),
+                "memory_blobs": len(self._blobs),
+                "memory_bytes": self._memory_bytes,
+                "disk_blobs": disk_count,
+                "spilled": self._spilled,
+            }
+
+    def _expire_idle_sessions(self, session_id):
+        # session_id の利用時刻を更新し、しばらく使われていないセッションを解放する
+        now = self._clock()
+        self._last_access[session_id] = now
+        if not self.disk_ttl_seconds:
+            return
+        for idle_id, last_access in list(self._last_access.items()):
+            if last_access < now - self.disk_ttl_seconds:
+                self.release_session(idle_id)
+
+    def _forget_blobs(self, blob_ids):
+        # 退避先から期限切れで消したデータへの参照を、セッションの一覧からも外す
+        for blob_id in blob_ids:
+            for session_id in self._refs.pop(blob_id, set()):
+                session_blobs = self._sessions.get(session_id)
+                if session_blobs is None:
+                    continue
+                session_blobs.discard(blob_id)
+                if not session_blobs:
+                    del self._sessions[session_id]
+                    self._last_access.pop(session_id, None)
+
+    def _add_to_memory(self, blob_id, data):
+        self._blobs[blob_id] = data
+        self._memory_bytes += len(data)
+
+    def _promote(self, blob_id):
+        # 退避先にあればメモリに戻す
+        row = self._conn.execute("SELECT data FROM blobs WHERE blob_id = ?", (blob_id,)).fetchone()
+        if row is None:
+            return False
+        with self._conn:
+            self._conn.execute("DELETE FROM blobs WHERE blob_id = ?", (blob_id,))
+        self._add_to_memory(blob_id, bytes(row[0]))
+        return True
+
+    def _spill(self, blob_id):
+        data = self._blobs.pop(blob_id)
+        self._memory_bytes -= len(data)
+        self._spilled += 1
+        now = self._clock()
+        expired = []
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blobs (blob_id, data, last_access) VALUES (?, ?, ?)",
+                (blob_id, data, now),
+            )
+            if self.disk_ttl_seconds:
+                cutoff = now - self.disk_ttl_seconds
+                expired = [row[0] for row in self._conn.execute(
+                    "SELECT blob_id FROM blobs WHERE last_access < ?", (cutoff,)
+                )]
+                self._conn.execute("DELETE FROM blobs WHERE last_access < ?", (cutoff,))
+        self._forget_blobs(expired)
+
+    def _enforce_limits(self, session_id):
+        # セッションごとの上限: そのセッションが参照するデータのうち古いものから退避する
+        session_blobs = self._sessions.get(session_id, set())
+        in_memory = [blob_id for blob_id in self._blobs if blob_id in session_blobs]
+        used = sum(len(self._blobs[blob_id]) for blob_id in in_memory)
+        for blob_id in in_memory[:-1]:
+            if used <= self.session_limit:
+                break
+            used -= len(self._blobs[blob_id])
+            self._spill(blob_id)
+        self._enforce_global_limit()
+
+    def _enforce_global_limit(self):
+        while self._memory_bytes > self.memory_limit and len(self._blobs) > 1:
+            self._spill(next(iter(self._blobs)))
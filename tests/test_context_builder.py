@@ -0,0 +1,90 @@
+import json
+import re
+
+import pytest
+
+from context_builder import build_file_context, estimate_tokens
+
+BUDGET = 800
+_marker_line = re.compile(r"^\s*(# )?\.\.\. \(\d+(行|セル)省略\) \.\.\.$")
+
+
+def python_source(functions=400):
+    lines = ["import os", "import json", ""]
+    for i in range(functions):
+        lines += [f"def func_{i}(value):", f"    result = value * {i} + len(str(value))", f"    return result + {i}", ""]
+    lines += ["class Worker:", "    def target_method(self, x):", "        if x < 0:",
+              "            raise ValueError('negative')", "        return x", ""]
+    return "\n".join(lines)
+
+
+def notebook_cells():
+    big_cell = "import pandas as pd\ndf = pd.read_csv('sales.csv')\n" + "df = df.assign(total=df.price * df.count)\n" * 400
+    return ["print(1)", big_cell, "x = 2"]
+
+
+CASES = {
+    "python": ("app.py", python_source(), "target_method で ValueError、func_123 も怪しい", None),
+    "python_single_line": ("one.py", "x = [" + ", ".join(str(i) for i in range(20000)) + "]", "", None),
+    "python_syntax_error": ("broken.py", python_source() + "\ndef broken(:\n", "", None),
+    "minified_js": ("app.min.js", "function a(){return 1};" * 5000, "", None),
+    "single_line_text": ("notes.txt", "あいうえお" * 10000, "", None),
+    "log": ("server.log", "\n".join(
+        [f"2024-01-01 00:00:{i % 60:02d} INFO request {i}" for i in range(5000)]
+        + ["Traceback (most recent call last):", '  File "app.py", line 3', "ValueError: bad"]
+        + [f"2024-01-01 00:01:{i % 60:02d} INFO done {i}" for i in range(2000)]
+    ), "ValueError", None),
+    "csv": ("data.csv", "id,name,price\n" + "\n".join(f"{i},item{i},{i * 1.5}" for i in range(20000)), "", None),
+    "wide_csv": ("wide.csv", ",".join(f"column_{i}" for i in range(20000)) + "\n"
+                 + ",".join(str(i) for i in range(20000)) + "\n", "", None),
+    "json": ("data.json", json.dumps({"items": [{"id": i, "name": f"item{i}"} for i in range(5000)]}), "", None),
+    "deep_json": ("deep.json", "[" * 40000 + "]" * 40000, "", None),
+    "broken_json": ("broken.json", '{"items": [' + ", ".join(f'{{"id": {i}}}' for i in range(5000)) + ",,]}", "", None),
+    "notebook": ("analysis.ipynb", "\n".join(notebook_cells()), "read_csv でエラーになります", notebook_cells()),
+}
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_reduced_context_fits_budget_and_is_not_empty(name):
+    file_name, content, query, cells = CASES[name]
+    assert estimate_tokens(content) > BUDGET
+    context = build_file_context(file_name, content, query, token_budget=BUDGET, cells=cells)
+    assert context.reduced
+    assert context.kept_tokens == estimate_tokens(context.text)
+    assert context.kept_tokens <= BUDGET
+    # 省略記号だけでなく、元の内容が残っている
+    assert any(line.strip() and not _marker_line.match(line) for line in context.text.split("\n"))
+
+
+def test_python_keeps_relevant_units_and_imports():
+    file_name, content, query, _ = CASES["python"]
+    text = build_file_context(file_name, content, query, token_budget=BUDGET).text
+    for expected in ("import os", "import json", "def func_123(value):", "raise ValueError('negative')"):
+        assert expected in text
+
+
+def test_oversized_relevant_cell_is_truncated_not_dropped():
+    file_name, content, query, cells = CASES["notebook"]
+    text = build_file_context(file_name, content, query, token_budget=BUDGET, cells=cells).text
+    assert "read_csv" in text
+    assert "文字省略" in text
+
+
+def test_wide_csv_lists_some_columns_and_counts_the_rest():
+    file_name, content, query, _ = CASES["wide_csv"]
+    text = build_file_context(file_name, content, query, token_budget=BUDGET).text
+    assert "column_0 (int)" in text
+    assert "列省略" in text
+
+
+def test_csv_header_row_is_dropped_when_columns_are_listed():
+    file_name, content, query, _ = CASES["csv"]
+    text = build_file_context(file_name, content, query, token_budget=BUDGET).text
+    assert "# 列: id (int), name (str), price (float)" in text
+    assert "\nid,name,price\n" not in text
+
+
+def test_small_file_is_kept_as_is():
+    context = build_file_context("small.py", "print('hello')\n", token_budget=BUDGET)
+    assert not context.reduced
+    assert context.text == "print('hello')\n"
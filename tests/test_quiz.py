@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+from quiz import StreamingQuizExtractor, parse_response, split_answer_key
+
+ANSWER_KEY = '<!--ANSWER_KEY {"answer": "3回", "accepted": ["3"], "concept": "range(3) は 0, 1, 2"} -->'
+
+SAMPLES = {
+    "answer_key_on_own_line": (
+        "for 文は同じ処理を繰り返すときに使います。\n"
+        "```python\nfor i in range(3):\n    print(i)\n```\n"
+        "\nQ: 次のコードで print は何回実行されますか？\n"
+        + ANSWER_KEY + "\n"
+    ),
+    "quiz_marker_in_code_block": (
+        "入力を受け取る例です。\n"
+        "```python\nanswer = input()\nQ: ここでは何が入りますか\n```\n"
+        "Q: input() の戻り値の型は何ですか？\n"
+        + ANSWER_KEY
+    ),
+    "japanese_marker_without_answer_key": (
+        "リストは [] で作ります。\n"
+        "   問題: [1, 2, 3] の長さはいくつですか？\n"
+    ),
+    "answer_key_inline_after_text": (
+        "解説はここまでです。" + ANSWER_KEY + "\n"
+        "Q: while 文との違いは何ですか？"
+    ),
+    "no_quiz": "ただの解説です。\n2行目の説明です。\n最後の行",
+}
+
+SECRETS = ["ANSWER_KEY", "<!--", "3回", "Q:", "問題:", "print は何回", "input() の戻り値", "while 文との違い", "長さはいくつ"]
+
+
+def split_points(text, rng, count):
+    points = sorted(rng.sample(range(1, len(text)), min(count, len(text) - 1)))
+    return [text[start:end] for start, end in zip([0] + points, points + [len(text)])]
+
+
+def chunkings(text):
+    # 1文字ずつ、2つに分ける全通り、ランダムな分け方
+    yield list(text)
+    for point in range(1, len(text)):
+        yield [text[:point], text[point:]]
+    rng = random.Random(len(text))
+    for _ in range(50):
+        yield split_points(text, rng, rng.randint(2, 12))
+
+
+@pytest.mark.parametrize("name", sorted(SAMPLES))
+def test_streaming_never_shows_quiz_or_answer_key(name):
+    text = SAMPLES[name]
+    for chunks in chunkings(text):
+        extractor = StreamingQuizExtractor()
+        for chunk in chunks:
+            extractor.feed(chunk)
+            visible = extractor.visible_text()
+            leaked = [secret for secret in SECRETS if secret in visible]
+            assert not leaked, (name, chunks, visible)
+
+
+@pytest.mark.parametrize("name", sorted(SAMPLES))
+def test_finish_matches_blocking_parse(name):
+    text = SAMPLES[name]
+    expected = parse_response(text)
+    for chunks in chunkings(text):
+        extractor = StreamingQuizExtractor()
+        for chunk in chunks:
+            extractor.feed(chunk)
+        assert extractor.finish() == expected
+        # 表示していた解説は、最終的な解説の先頭部分になっている
+        assert expected[1].startswith(extractor.visible_text())
+
+
+def test_split_answer_key_drops_non_string_concept():
+    _, answer_key = split_answer_key('解説\nQ: 何回？\n<!--ANSWER_KEY {"answer": "3", "concept": ["x"]} -->')
+    assert answer_key == {"answer": "3", "concept": ""}
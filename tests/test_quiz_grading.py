@@ -0,0 +1,74 @@
+import pytest
+
+from quiz_grading import build_grading_prompt, grade_locally, normalize_answer, parse_number
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("「３回」", "3回"),
+    ("  `print` ", "print"),
+    ("ABC。", "abc"),
+    # 数値の一部になる「.」「,」は残す
+    (".5", ".5"),
+    ("1,5", "1,5"),
+    ("'42'.", "42"),
+])
+def test_normalize_answer(text, expected):
+    assert normalize_answer(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("42", 42),
+    (".5", 0.5),
+    ("1/2", 0.5),
+    ("1,000", 1000),
+    ("12,345.5", 12345.5),
+    ("1e3", 1000),
+])
+def test_parse_number(text, expected):
+    assert parse_number(text) == expected
+
+
+@pytest.mark.parametrize("text", ["1,5", "10,00", "1,0000", "abc", ""])
+def test_parse_number_rejects_ambiguous_or_non_numeric(text):
+    assert parse_number(text) is None
+
+
+def test_matching_text_is_correct():
+    grade = grade_locally("３回", {"answer": "3回"})
+    assert grade.correct
+
+
+def test_equal_numbers_in_other_notation_are_correct():
+    assert grade_locally("0.5", {"answer": "1/2"}).correct
+    assert grade_locally("1,000", {"answer": "1000"}).correct
+
+
+def test_leading_decimal_point_is_not_dropped():
+    grade = grade_locally("5", {"answer": ".5"})
+    assert grade is not None and not grade.correct
+
+
+def test_ambiguous_comma_goes_to_api_grader():
+    assert grade_locally("1,5", {"answer": "15"}) is None
+
+
+def test_wrong_number_feedback_does_not_reveal_concept():
+    grade = grade_locally("3", {"answer": "4", "concept": "range(4) は 4 回繰り返す"})
+    assert not grade.correct
+    assert "range(4)" not in grade.feedback
+
+
+def test_text_mismatch_goes_to_api_grader():
+    assert grade_locally("for 文", {"answer": "while 文"}) is None
+
+
+def test_missing_answer_key_goes_to_api_grader():
+    assert grade_locally("3", {}) is None
+    assert grade_locally("3", None) is None
+
+
+@pytest.mark.parametrize("concept", [["x"], {"text": "x"}, None])
+def test_non_string_concept_is_ignored(concept):
+    answer_key = {"answer": "3", "concept": concept}
+    assert grade_locally("3", answer_key).feedback == "- **採点結果:** 正解です！"
+    assert "確認したい考え方: （記載なし）" in build_grading_prompt("Q: 何回？", answer_key, "たぶん3", "ユーザー")
@@ -0,0 +1,172 @@
+import threading
+
+import pytest
+
+from request_scheduler import PRIORITY_EXPLANATION, PRIORITY_GRADING, RequestScheduler
+
+
+class ServiceUnavailable(Exception):
+    """google.api_core.exceptions.ServiceUnavailable の代わり (クラス名で一時的なエラーと判定される)。"""
+
+
+class FakeTime:
+    """sleep すると時計が進む時計。hold() 中の sleep は release() まで戻らない。"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+        self._lock = threading.Lock()
+        self._released = threading.Event()
+        self._released.set()
+        self.sleeping = threading.Event()
+
+    def clock(self):
+        with self._lock:
+            return self.now
+
+    def sleep(self, seconds):
+        self.sleeping.set()
+        self._released.wait(5)
+        with self._lock:
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+    def hold(self):
+        self.sleeping.clear()
+        self._released.clear()
+
+    def release(self):
+        self._released.set()
+
+
+def make_scheduler(fake_time, **kwargs):
+    options = {"requests_per_minute": 60, "burst": 1, "max_concurrency": 4, "max_retries": 4,
+               "base_delay": 1.0, "max_delay": 30.0, "jitter": lambda: 0.0}
+    options.update(kwargs)
+    return RequestScheduler(clock=fake_time.clock, sleep=fake_time.sleep, **options)
+
+
+def test_transient_errors_are_retried_with_backoff_and_rate_tokens():
+    fake_time = FakeTime()
+    scheduler = make_scheduler(fake_time, requests_per_minute=60, base_delay=0.2)
+    calls = []
+
+    def flaky():
+        calls.append(fake_time.clock())
+        if len(calls) < 3:
+            raise ServiceUnavailable("busy")
+        return "ok"
+
+    request = scheduler.submit(flaky)
+    assert request.result(timeout=5) == "ok"
+    assert request.attempts == 3
+    assert scheduler.stats()["retries"] == 2
+    # バックオフ (0.2 * 2**n の半分) のあと、再試行のたびにトークン (1秒に1つ) が溜まるまで待つ
+    assert fake_time.sleeps == pytest.approx([0.1, 0.9, 0.2, 0.8])
+    assert calls == pytest.approx([0.0, 1.0, 2.0])
+
+
+def test_retries_stop_after_max_retries():
+    fake_time = FakeTime()
+    scheduler = make_scheduler(fake_time, requests_per_minute=6000, max_retries=2)
+
+    def always_busy():
+        raise ServiceUnavailable("busy")
+
+    request = scheduler.submit(always_busy)
+    with pytest.raises(ServiceUnavailable):
+        request.result(timeout=5)
+    assert request.attempts == 3
+
+
+def test_non_transient_errors_are_not_retried():
+    fake_time = FakeTime()
+    scheduler = make_scheduler(fake_time)
+
+    def broken():
+        raise ValueError("bad request")
+
+    request = scheduler.submit(broken)
+    with pytest.raises(ValueError):
+        request.result(timeout=5)
+    assert request.attempts == 1
+    assert scheduler.stats()["retries"] == 0
+
+
+def test_grading_overtakes_explanations_waiting_for_a_rate_token():
+    fake_time = FakeTime()
+    scheduler = make_scheduler(fake_time, requests_per_minute=120, burst=1, max_concurrency=4)
+    order = []
+    order_lock = threading.Lock()
+
+    def job(name):
+        def run():
+            with order_lock:
+                order.append(name)
+        return run
+
+    # 1件目でバーストを使い切り、2件目のトークン待ちで止めておく
+    fake_time.hold()
+    requests = [scheduler.submit(job(f"explanation-{i}"), PRIORITY_EXPLANATION) for i in range(2)]
+    assert fake_time.sleeping.wait(5)
+    requests += [scheduler.submit(job(f"explanation-{i}"), PRIORITY_EXPLANATION) for i in range(2, 8)]
+    requests.append(scheduler.submit(job("grading"), PRIORITY_GRADING))
+    fake_time.release()
+    for request in requests:
+        request.result(timeout=5)
+
+    # トークンを待っている解説はまだキューから取り出されていないので、採点が先に実行される
+    assert order == ["explanation-0", "grading"] + [f"explanation-{i}" for i in range(1, 8)]
+
+
+def test_position_counts_higher_priority_requests_first():
+    fake_time = FakeTime()
+    scheduler = make_scheduler(fake_time, requests_per_minute=6000, max_concurrency=1)
+    started = threading.Event()
+    finish = threading.Event()
+
+    def blocking():
+        started.set()
+        finish.wait(5)
+
+    first = scheduler.submit(blocking)
+    assert started.wait(5)
+    explanation = scheduler.submit(lambda: None, PRIORITY_EXPLANATION)
+    grading = scheduler.submit(lambda: None, PRIORITY_GRADING)
+    assert scheduler.position(first) == 0
+    assert scheduler.position(grading) == 1
+    assert scheduler.position(explanation) == 2
+    finish.set()
+    for request in (first, explanation, grading):
+        request.result(timeout=5)
+    assert scheduler.position(grading) == 0
+
+
+def test_requests_with_the_same_key_are_coalesced():
+    fake_time = FakeTime()
+    scheduler = make_scheduler(fake_time, requests_per_minute=6000)
+    started = threading.Event()
+    finish = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        finish.wait(5)
+        return "answer"
+
+    first = scheduler.submit(slow, coalesce_key="same")
+    assert started.wait(5)
+    second = scheduler.submit(slow, coalesce_key="same")
+    other = scheduler.submit(lambda: "other", coalesce_key="other")
+    assert second is first
+    assert first.coalesced == 1
+    finish.set()
+    assert second.result(timeout=5) == "answer"
+    assert other.result(timeout=5) == "other"
+    assert len(calls) == 1
+
+    # 終わったあとに同じキーで予約すると、新しく呼び出す
+    third = scheduler.submit(lambda: "again", coalesce_key="same")
+    assert third is not first
+    assert third.result(timeout=5) == "again"
@@ -0,0 +1,57 @@
+from session_store import SessionStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_store(tmp_path, clock, **kwargs):
+    options = {"memory_limit": 1024 * 1024, "session_limit": 1024 * 1024, "disk_ttl_seconds": 60}
+    options.update(kwargs)
+    return SessionStore(path=str(tmp_path / "store.sqlite3"), clock=clock, **options)
+
+
+def test_idle_sessions_are_released(tmp_path):
+    clock = FakeClock()
+    store = make_store(tmp_path, clock)
+    closed_blob = store.put_text("closed", "closed session answer")
+    clock.now += 30
+    active_blob = store.put_text("active", "active session answer")
+    clock.now += 40
+    store.touch("active")
+
+    assert store.stats()["sessions"] == 1
+    assert store.get_text(closed_blob) is None
+    assert store.get_text(active_blob) == "active session answer"
+
+
+def test_shared_blob_survives_until_every_session_is_gone(tmp_path):
+    clock = FakeClock()
+    store = make_store(tmp_path, clock)
+    blob_id = store.put_text("a", "shared answer")
+    store.put_text("b", "shared answer")
+    store.release_session("a")
+    assert store.get_text(blob_id) == "shared answer"
+    store.release_session("b")
+    assert store.get_text(blob_id) is None
+    assert store.stats()["sessions"] == 0
+
+
+def test_expired_spilled_blobs_are_removed_from_sessions(tmp_path):
+    clock = FakeClock()
+    # 上限が小さいので、新しいデータを入れるたびに古いものが退避される
+    store = make_store(tmp_path, clock, memory_limit=1, session_limit=1, disk_ttl_seconds=3600)
+    old_blob = store.put_text("old", "old answer")
+    store.put_text("other", "something else")
+    clock.now += 7200
+    # "old" はまだ使われているが、退避したデータは期限切れで消える
+    store.touch("old")
+    store.put_text("new", "new answer")
+    store.put_text("new", "newer answer")
+
+    assert store.get_text(old_blob) is None
+    assert store.stats()["sessions"] == 1
@@ -0,0 +1,31 @@
+from upload_batch import SUMMARY_MAX_OUTPUT_TOKENS, build_batch_context, files_to_summarize, load_files
+
+BUDGET = 8000
+
+
+def make_files(count, chars):
+    line = "def add(a, b):\n    return a + b\n"
+    entries = [
+        (f"module_{i}.py", (f"# module {i}\n" + line * (chars // len(line))).encode("utf-8"))
+        for i in range(count)
+    ]
+    return load_files(entries)
+
+
+def test_summary_length_follows_each_files_share():
+    files = make_files(20, 20_000)
+    large_files = files_to_summarize(files, BUDGET)
+    assert len(large_files) == 20
+    assert all(f.summary_tokens == BUDGET // 20 for f in large_files)
+    assert all(f.summary_tokens <= SUMMARY_MAX_OUTPUT_TOKENS for f in large_files)
+
+
+def test_oversized_summary_is_trimmed_not_discarded():
+    files = make_files(20, 20_000)
+    for batch_file in files_to_summarize(files, BUDGET):
+        batch_file.summary = "- 関数 add は2つの引数を足した値を返す\n" * 100
+    context = build_batch_context(files, token_budget=BUDGET)
+    assert len(context.summarized) == 20
+    assert not context.excerpted
+    assert "(大きいため要約、一部省略)" in context.text
+    assert context.kept_tokens <= BUDGET
@@ -0,0 +1,302 @@
+"""複数ファイル・.zip のアップロードをまとめて読み込み、プロンプトに載せる内容を組み立てる。
+
+- .zip は展開し、中のファイルも通常のアップロードと同じ拡張子の許可リストで絞り込む
+- デコードはスレッドプールで並列に行う (file_decoding.decode_upload はスレッドから呼べる)
+- 1ファイルあたりの文字数の上限 (50万文字) は、単体のアップロードと同じく各ファイルに適用する
+- プロンプトに収まらない大きなファイルは、ファイルごとに並列で Gemini に要約させ (map)、
+  その要約を最終的な回答のプロンプトにまとめる (reduce)。要約はファイル内容のハッシュごとに保存する
+
+Streamlit や Gemini には依存しないので、要約の依頼方法は呼び出し側から渡す。
+"""
+import io
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import cached_property
+
+from context_builder import DEFAULT_TOKEN_BUDGET, build_file_context, estimate_tokens
+from file_decoding import decode_upload
+from response_cache import make_cache_key
+
+MAX_FILE_CHARS = 500_000
+DEFAULT_MAX_FILES = int(os.getenv("UPLOAD_MAX_FILES", "50"))
+# .zip を展開したときの合計サイズの上限 (圧縮率の極端なファイルでメモリを使い切らないように)
+DEFAULT_MAX_ARCHIVE_BYTES = int(float(os.getenv("UPLOAD_MAX_ARCHIVE_MB", "50")) * 1024 * 1024)
+DEFAULT_WORKERS = int(os.getenv("UPLOAD_DECODE_WORKERS", str(min(8, os.cpu_count() or 1))))
+# 要約を依頼するときに送るファイル内容のトークン数の上限と、要約の長さ
+SUMMARY_INPUT_TOKEN_BUDGET = int(os.getenv("FILE_SUMMARY_INPUT_TOKEN_BUDGET", "100000"))
+SUMMARY_MAX_OUTPUT_TOKENS = int(os.getenv("FILE_SUMMARY_MAX_OUTPUT_TOKENS", "1024"))
+# 要約の依頼文を変えたら更新する (保存済みの要約を使わないようにするため)
+SUMMARY_PROMPT_VERSION = "2"
+
+# UTF-8 では1文字が最大4バイトなので、これを超えるファイルは展開せずに文字数超過とする
+_max_file_bytes = MAX_FILE_CHARS * 4
+
+
+@dataclass
+class BatchFile:
+    """アップロードされた (または .zip から取り出した) ファイル1つ分の読み込み結果。"""
+    name: str
+    size: int
+    # ok / skipped (対象外) / too_large (文字数超過) / decode_error / archive_error
+    status: str = "ok"
+    message: str = ""
+    decoded: object = None
+    # 要約した場合の内容 (build_batch_context で使う)
+    summary: str = None
+    # 要約の長さの上限 (files_to_summarize がこのファイルに配分されたトークン数に合わせる)
+    summary_tokens: int = SUMMARY_MAX_OUTPUT_TOKENS
+
+    @property
+    def ok(self):
+        return self.status == "ok"
+
+    @property
+    def text(self):
+        return self.decoded.text if self.decoded is not None else None
+
+    @cached_property
+    def tokens(self):
+        return estimate_tokens(self.text) if self.ok else 0
+
+
+@dataclass
+class BatchContext:
+    text: str
+    original_tokens: int
+    kept_tokens: int
+    # 要約・抜粋に置き換えたファイル名
+    summarized: list = field(default_factory=list)
+    excerpted: list = field(default_factory=list)
+
+    @property
+    def reduced(self):
+        return bool(self.summarized or self.excerpted)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # デコード用のスレッドプールはプロセス全体で1つだけ作る
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, DEFAULT_WORKERS), thread_name_prefix="upload-decode")
+        return _executor
+
+
+def _extension(name):
+    return name.rsplit(".", 1)[-1].lower() if "." in name else ""
+
+
+def _expand_zip(name, data, allowed_extensions, remaining_files, max_archive_bytes):
+    """.zip の中から対象のファイルを取り出し、(読み込む項目, 除外したファイル) を返す。"""
+    entries, skipped = [], []
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            total = 0
+            for info in archive.infolist():
+                member = f"{name}/{info.filename}"
+                base = info.filename.rsplit("/", 1)[-1]
+                if info.is_dir() or info.filename.startswith("__MACOSX/") or base.startswith("."):
+                    continue
+                if _extension(base) not in allowed_extensions:
+                    skipped.append(BatchFile(member, info.file_size, "skipped", "対象外の拡張子のため読み込みません"))
+                    continue
+                if info.file_size > _max_file_bytes:
+                    skipped.append(BatchFile(member, info.file_size, "too_large", f"文字数が制限 ({MAX_FILE_CHARS}文字) を超えています"))
+                    continue
+                if len(entries) >= remaining_files:
+                    skipped.append(BatchFile(member, info.file_size, "skipped", "ファイル数の上限を超えたため読み込みません"))
+                    continue
+                total += info.file_size
+                if total > max_archive_bytes:
+                    skipped.append(BatchFile(member, info.file_size, "skipped", "展開後の合計サイズが上限を超えたため読み込みません"))
+                    continue
+                entries.append((member, archive.read(info)))
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError, RuntimeError) as e:
+        # 壊れたファイル・未対応の圧縮方式・パスワード付きなど
+        return [], [BatchFile(name, len(data), "archive_error", f"展開できませんでした ({e})")]
+    return entries, skipped
+
+
+def expand_uploads(uploads, allowed_extensions, max_files=DEFAULT_MAX_FILES,
+                   max_archive_bytes=DEFAULT_MAX_ARCHIVE_BYTES):
+    """(ファイル名, データ) のリストから、.zip を展開した読み込み対象と、除外したファイルを返す。"""
+    allowed = {extension.lower() for extension in allowed_extensions}
+    entries, skipped = [], []
+    for name, data in uploads:
+        if _extension(name) == "zip":
+            archive_entries, archive_skipped = _expand_zip(
+                name, data, allowed, max_files - len(entries), max_archive_bytes
+            )
+            entries += archive_entries
+            skipped += archive_skipped
+        elif _extension(name) not in allowed:
+            skipped.append(BatchFile(name, len(data), "skipped", "対象外の拡張子のため読み込みません"))
+        elif len(entries) >= max_files:
+            skipped.append(BatchFile(name, len(data), "skipped", "ファイル数の上限を超えたため読み込みません"))
+        else:
+            entries.append((name, data))
+    return entries, skipped
+
+
+def _load_one(entry):
+    name, data = entry
+    decoded = decode_upload(name, data)
+    result = BatchFile(name, decoded.size, decoded=decoded)
+    if decoded.error:
+        result.status = "decode_error"
+        result.message = decoded.error
+    elif len(decoded.text) > MAX_FILE_CHARS:
+        result.status = "too_large"
+        result.message = f"文字数 ({len(decoded.text)}文字) が制限 ({MAX_FILE_CHARS}文字) を超えています"
+    else:
+        # トークン数の見積もりもワーカーで済ませておく
+        result.tokens
+    return result
+
+
+def load_files(entries):
+    """読み込み対象をスレッドプールで並列にデコードし、BatchFile のリストを入力順で返す。"""
+    if len(entries) <= 1:
+        return [_load_one(entry) for entry in entries]
+    return list(_get_executor().map(_load_one, entries))
+
+
+def _allocate_budgets(files, token_budget):
+    """上限をファイルに配分する。小さいファイルから順にそのまま入れ、残りを大きいファイルで等分する。
+
+    id(BatchFile) -> 配分したトークン数 と、配分に収まらないファイルのリストを返す
+    (.zip の中と外で同じ名前のファイルがあり得るため、名前ではなくオブジェクトで区別する)。
+    """
+    budgets, oversized = {}, []
+    remaining = token_budget
+    pending = sorted(files, key=lambda f: f.tokens)
+    for index, batch_file in enumerate(pending):
+        share = remaining // (len(pending) - index)
+        if batch_file.tokens <= share:
+            budgets[id(batch_file)] = batch_file.tokens
+            remaining -= batch_file.tokens
+        else:
+            for large_file in pending[index:]:
+                budgets[id(large_file)] = share
+                oversized.append(large_file)
+            break
+    return budgets, oversized
+
+
+def files_to_summarize(files, token_budget=DEFAULT_TOKEN_BUDGET):
+    """配分されたトークン数に収まらず、要約 (map) が必要なファイルを返す。
+
+    要約が配分に収まるよう、各ファイルの summary_tokens を配分されたトークン数に合わせる。
+    """
+    ok_files = [f for f in files if f.ok]
+    if len(ok_files) <= 1:
+        # 1ファイルだけなら、質問に関係する部分の抜粋 (context_builder) で十分に収まる
+        return []
+    budgets, oversized = _allocate_budgets(ok_files, token_budget)
+    for batch_file in oversized:
+        batch_file.summary_tokens = max(1, min(SUMMARY_MAX_OUTPUT_TOKENS, budgets[id(batch_file)]))
+    return oversized
+
+
+def summary_cache_key(batch_file, model_name=""):
+    # 要約は質問に依存しない内容にしてあるので、ファイル内容のハッシュと要約の長さだけをキーにする
+    return make_cache_key(
+        f"file-summary:{SUMMARY_PROMPT_VERSION}:{batch_file.summary_tokens}:{batch_file.decoded.digest}", model_name
+    )
+
+
+def build_summary_prompt(batch_file):
+    content = build_file_context(
+        batch_file.name, batch_file.text, token_budget=SUMMARY_INPUT_TOKEN_BUDGET, cells=batch_file.decoded.cells
+    ).text
+    return "\n".join([
+        "あなたはプログラミング学習者のコードを読むアシスタントです。",
+        "以下のファイルを、あとで別の質問に答えるための資料として要約してください。",
+        "- ファイルの役割と全体の構成",
+        "- 主な関数・クラス・設定項目と、その役割",
+        "- エラーやバグの原因になりそうな箇所 (行番号や名前を含める)",
+        "要約はマークダウンの箇条書きで、元のコードの重要な行はそのまま引用してください。",
+        # 配分を超えた要約は切り詰められるので、長さの上限を依頼文でも伝える
+        f"要約全体は日本語でおよそ{batch_file.summary_tokens}文字以内に収めてください。",
+        f"\n--- ファイル: {batch_file.name} ---",
+        content,
+        "--- ファイルここまで ---",
+    ])
+
+
+def summarize_files(files, submit, cache=None, model_name=""):
+    """要約が必要なファイルを並列に要約し、batch_file.summary に設定する (map)。
+
+    submit(prompt, coalesce_key, max_output_tokens) はリクエストを予約し、
+    result() で要約テキストを返すオブジェクトを返す。max_output_tokens には batch_file.summary_tokens を渡す。
+    要約に失敗したファイルは summary が None のままになり、build_batch_context で抜粋に切り替わる。
+    失敗したファイルの (名前, 例外) のリストを返す。
+    """
+    pending = []
+    for batch_file in files:
+        key = summary_cache_key(batch_file, model_name)
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            batch_file.summary = cached
+        else:
+            # すべて先に予約してから結果を待つので、要約は並列に進む
+            pending.append((batch_file, key, submit(build_summary_prompt(batch_file), key, batch_file.summary_tokens)))
+    errors = []
+    for batch_file, key, request in pending:
+        try:
+            batch_file.summary = request.result()
+        except Exception as e:
+            errors.append((batch_file.name, e))
+            continue
+        if cache is not None and batch_file.summary:
+            cache.put(key, batch_file.summary)
+    return errors
+
+
+def build_batch_context(files, query="", token_budget=DEFAULT_TOKEN_BUDGET):
+    """読み込めたファイルをまとめ、上限内に収めたテキストにする (reduce)。
+
+    配分に収まるファイルはそのまま、収まらないファイルは要約 (あれば) か質問に関係する部分の抜粋にする。
+    要約が配分を超えた場合は、捨てずに配分まで切り詰めて使う。
+    """
+    ok_files = [f for f in files if f.ok]
+    budgets, oversized = _allocate_budgets(ok_files, token_budget)
+    oversized_ids = {id(f) for f in oversized}
+    sections = []
+    kept_tokens = 0
+    summarized, excerpted = [], []
+    for batch_file in ok_files:
+        budget = budgets[id(batch_file)]
+        label = ""
+        if id(batch_file) not in oversized_ids:
+            content = batch_file.text
+        elif batch_file.summary:
+            content = batch_file.summary
+            label = " (大きいため要約)"
+            if estimate_tokens(content) > budget:
+                content = build_file_context(f"{batch_file.name}.summary.md", content, query, token_budget=budget).text
+                label = " (大きいため要約、一部省略)"
+            summarized.append(batch_file.name)
+        else:
+            context = build_file_context(
+                batch_file.name, batch_file.text, query, token_budget=budget, cells=batch_file.decoded.cells
+            )
+            content = context.text
+            label = " (大きいため関係しそうな部分のみ抜粋)"
+            excerpted.append(batch_file.name)
+        kept_tokens += estimate_tokens(content)
+        sections.append(f"### ファイル: {batch_file.name}{label}\n{content}")
+    return BatchContext(
+        text="\n\n".join(sections),
+        original_tokens=sum(f.tokens for f in ok_files),
+        kept_tokens=kept_tokens,
+        summarized=summarized,
+        excerpted=excerpted,
+    )